@@ -1,7 +1,13 @@
 import asyncio
+import importlib.util
+import os
+import sys
 import csv
 import time
 import json
+import sqlite3
+import struct
+from array import array
 from datetime import datetime
 from bleak import BleakScanner, BleakClient
 
@@ -23,44 +29,55 @@ def next_seq() -> int:
     return val
 
 # ── CRC8 Table & Helpers ────────────────────────────────────────────────────
-CRC8_TABLE = [
-    0x00,0x07,0x0E,0x09,0x1C,0x1B,0x12,0x15,0x38,0x3F,0x36,0x31,0x24,0x23,0x2A,0x2D,
-    0x70,0x77,0x7E,0x79,0x6C,0x6B,0x62,0x65,0x48,0x4F,0x46,0x41,0x54,0x53,0x5A,0x5D,
-    0xE0,0xE7,0xEE,0xE9,0xFC,0xFB,0xF2,0xF5,0xD8,0xDF,0xD6,0xD1,0xC4,0xC3,0xCA,0xCD,
-    0x90,0x97,0x9E,0x99,0x8C,0x8B,0x82,0x85,0xA8,0xAF,0xA6,0xA1,0xB4,0xB3,0xBA,0xBD,
-    0xC7,0xC0,0xC9,0xCE,0xDB,0xDC,0xD5,0xD2,0xFF,0xF8,0xF1,0xF6,0xE3,0xE4,0xED,0xEA,
-    0xB7,0xB0,0xB9,0xBE,0xAB,0xAC,0xA5,0xA2,0x8F,0x88,0x81,0x86,0x93,0x94,0x9D,0x9A,
-    0x27,0x20,0x29,0x2E,0x3B,0x3C,0x35,0x32,0x1F,0x18,0x11,0x16,0x03,0x04,0x0D,0x0A,
-    0x57,0x50,0x59,0x5E,0x4B,0x4C,0x45,0x42,0x6F,0x68,0x61,0x66,0x73,0x74,0x7D,0x7A,
-    0x89,0x8E,0x87,0x80,0x95,0x92,0x9B,0x9C,0xB1,0xB6,0xBF,0xB8,0xAD,0xAA,0xA3,0xA4,
-    0xF9,0xFE,0xF7,0xF0,0xE5,0xE2,0xEB,0xEC,0xC1,0xC6,0xCF,0xC8,0xDD,0xDA,0xD3,0xD4,
-    0x69,0x6E,0x67,0x60,0x75,0x72,0x7B,0x7C,0x51,0x56,0x5F,0x58,0x4D,0x4A,0x43,0x44,
-    0x19,0x1E,0x17,0x10,0x05,0x02,0x0B,0x0C,0x21,0x26,0x2F,0x28,0x3D,0x3A,0x33,0x34,
-    0x4E,0x49,0x40,0x47,0x52,0x55,0x5C,0x5B,0x76,0x71,0x78,0x7F,0x6A,0x6D,0x64,0x63,
-    0x3E,0x39,0x30,0x37,0x22,0x25,0x2C,0x2B,0x06,0x01,0x08,0x0F,0x1A,0x1D,0x14,0x13,
-    0xAE,0xA9,0xA0,0xA7,0xB2,0xB5,0xBC,0xBB,0x96,0x91,0x98,0x9F,0x8A,0x8D,0x84,0x83,
-    0xDE,0xD9,0xD0,0xD7,0xC2,0xC5,0xCC,0xCB,0xE6,0xE1,0xE8,0xEF,0xFA,0xFD,0xF4,0xF3,
-]
-
-def cal_crc8(buf: bytes) -> int:
-    crc = 0
-    for b in buf:
-        crc = CRC8_TABLE[(crc ^ b) & 0xFF]
-    return crc
+# The O2Ring and the BP2 share the same CRC-8.  Load o2r's o2crc.py by path
+# rather than importing the o2r package, which would pull in numpy.
+def _load_o2crc():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'o2r', 'o2r', 'o2crc.py')
+    spec = importlib.util.spec_from_file_location('o2crc', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
 
-def build_cmd(opcode: int, payload: bytes = b"") -> bytes:
+_o2crc = _load_o2crc()
+CRC8_TABLE = _o2crc.CRC8_TABLE
+crc8 = _o2crc.crc8
+
+# CRC-8 of each byte value followed by the 2 bytes after the seq field (len
+# is 0 in a payload-less command).  The CRC is linear with a zero seed, so
+# setting the seq byte to v flips the CRC by this table's entry v.
+_SEQ_CRC = _o2crc.crc8_shift_table(2)
+
+def _pack_cmd(opcode: int, seq: int, payload: bytes) -> bytes:
     length = len(payload)
     hdr = bytes([
         0xA5,
         opcode,
         (~opcode) & 0xFF,
         0x00,
-        next_seq(),
+        seq,
         length & 0xFF,
         (length >> 8) & 0xFF,
     ])
     pkt = hdr + payload
-    return pkt + bytes([cal_crc8(pkt)])
+    return pkt + bytes([crc8(pkt)])
+
+# opcode -> the command without a payload and with seq 0, only seq changes
+_templates: dict = {}
+
+def build_cmd(opcode: int, payload: bytes = b"") -> bytes:
+    if payload:
+        return _pack_cmd(opcode, next_seq(), payload)
+
+    base = _templates.get(opcode)
+    if base is None:
+        base = _templates[opcode] = _pack_cmd(opcode, 0, b"")
+    seq = next_seq()
+    if not seq:
+        return base
+    pkt = bytearray(base)
+    pkt[4] = seq
+    pkt[7] ^= _SEQ_CRC[seq]
+    return bytes(pkt)
 
 cmd_get_rt_param = lambda: build_cmd(RT_PARAM)
 cmd_get_rt_data  = lambda: build_cmd(RT_DATA)
@@ -69,31 +86,66 @@ cmd_get_rt_data  = lambda: build_cmd(RT_DATA)
 def u16(b: bytes) -> int: return int.from_bytes(b, 'little')
 def i16(b: bytes) -> int: return int.from_bytes(b, 'little', signed=True)
 
-def parse_rtdata(payload: bytes) -> dict:
+def wave_bytes(blk) -> memoryview:
+    """Raw little-endian int16 wave samples of an RT_DATA wave block, no copy"""
+    idx = 21
+    if len(blk) < idx+2:
+        return memoryview(b"")
+    wave_len = u16(blk[idx:idx+2])
+    idx += 2
+    # a short frame only gives what it has
+    end = min(idx + 2*wave_len, idx + (len(blk) - idx) // 2 * 2)
+    return memoryview(blk)[idx:end]
+
+def wave_samples(wave) -> array:
+    """Decode raw wave bytes (from wave_bytes) to an array('h') of samples"""
+    samples = array('h')
+    samples.frombytes(wave)
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return samples
+
+def parse_rtdata(payload: bytes, wave_json: bool = True) -> dict:
+    """
+    Decode an RT_DATA payload.  row['wave'] holds the raw little-endian
+    wave samples as bytes; row['wave_samples'] is the JSON list of them,
+    only built when wave_json is set.
+    """
+    row = _parse_rtdata(payload, wave_json)
+    wave = row['wave']
+    row['wave'] = bytes(wave)
+    wave.release()
+    return row
+
+def _parse_rtdata(payload, wave_json: bool = True) -> dict:
+    """
+    parse_rtdata() without copying the wave: row['wave'] is a memoryview
+    into payload.  For a FrameDecoder frame it has to be released before
+    the next feed(), which can't resize the decoder's buffer while it is
+    exported; capture_bp2() writes it out straight away.
+    """
     row = {
         'sys':           '',
         'dia':           '',
         'pr':            '',
         'ecg_duration_ms':'',
         'ecg_hr':        '',
-        'wave_samples':  ''
+        'wave_samples':  '',
+        'wave':          memoryview(b""),
+        'dtype':         None,
     }
     blk = payload[9:]
     if not blk:
         return row
     dtype = blk[0]
     data  = blk[1:21]
-    idx   = 21
+    row['dtype'] = dtype
 
     # wave samples
-    if len(blk) >= idx+2:
-        wave_len = u16(blk[idx:idx+2])
-        idx += 2
-        samples = []
-        for i in range(wave_len):
-            off = idx + 2*i
-            samples.append(i16(blk[off:off+2]))
-        row['wave_samples'] = json.dumps(samples)
+    if len(blk) >= 23:
+        row['wave'] = wave_bytes(blk)
+        if wave_json:
+            row['wave_samples'] = json.dumps(wave_samples(row['wave']).tolist())
 
     if dtype == 0x01:  # BP result
         row['sys'] = u16(data[2:4])
@@ -107,44 +159,327 @@ def parse_rtdata(payload: bytes) -> dict:
 
     return row
 
+# ── Waveform Storage ────────────────────────────────────────────────────────
+class WaveformSink:
+    """
+    Binary waveform file: every wave sample of a capture, as little-endian
+    int16, back to back.  write() appends a frame's samples straight from
+    the payload and returns (offset, count) in samples, which the CSV keeps
+    in place of the JSON list so each row can find its samples again.
+    Read the file back with load_waveform().
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.fp = open(filename, 'wb')
+        self.samples = 0
+
+    def write(self, wave) -> tuple:
+        offset = self.samples
+        count = len(wave) // 2
+        if count:
+            self.fp.write(wave)
+            self.samples += count
+        return offset, count
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+def load_waveform(filename: str):
+    """All samples of a WaveformSink file, a NumPy int16 array if available"""
+    try:
+        import numpy as np
+    except ImportError:
+        with open(filename, 'rb') as f:
+            return wave_samples(f.read())
+    return np.fromfile(filename, dtype='<i2')
+
+# ── Frame Decoder ───────────────────────────────────────────────────────────
+class FrameDecoder:
+    """
+    Streaming decoder for BP2 notifications.
+
+    Frames are 0xA5, opcode, ~opcode, 0x00, seq, len (LE16), payload, crc8.
+    Incoming data is appended to one buffer and a read cursor walks it;
+    the consumed prefix is only dropped once it is at least half the buffer,
+    so decoding stays linear however noisy the link is.  Resync jumps to the
+    next 0xA5 with find() and the opcode/~opcode pair is checked before any
+    payload is waited for.
+
+    feed() yields each good frame (header through crc) as a memoryview into
+    the buffer.  It is only valid until the generator resumes, so copy it
+    with bytes() to keep it.
+    """
+
+    HEADER_LEN = 7
+
+    def __init__(self, max_len: int = 4096):
+        self.max_len = max_len
+        self.buf = bytearray()
+        self.pos = 0
+        self.frames = 0
+        self.resync_bytes = 0
+        self.crc_errors = 0
+
+    def stats(self) -> dict:
+        return {
+            'frames':       self.frames,
+            'resync_bytes': self.resync_bytes,
+            'crc_errors':   self.crc_errors,
+        }
+
+    def feed(self, data: bytes):
+        buf = self.buf
+        if self.pos >= len(buf):
+            buf.clear()
+            self.pos = 0
+        elif self.pos > len(buf) // 2:
+            del buf[:self.pos]
+            self.pos = 0
+        buf += data
+
+        pos = self.pos
+        end = len(buf)
+        while pos < end:
+            if buf[pos] != 0xA5:
+                start = buf.find(0xA5, pos)
+                if start < 0:
+                    start = end
+                self.resync_bytes += start - pos
+                pos = start
+                continue
+
+            if pos + self.HEADER_LEN > end:
+                break
+
+            length = buf[pos+5] | (buf[pos+6] << 8)
+            if (buf[pos+1] ^ buf[pos+2]) != 0xFF or length > self.max_len:
+                self.resync_bytes += 1
+                pos += 1
+                continue
+
+            frame_end = pos + self.HEADER_LEN + length + 1
+            if frame_end > end:
+                break
+
+            with memoryview(buf) as view:
+                frame = view[pos:frame_end]
+                if frame[-1] != crc8(frame[:-1]):
+                    frame.release()
+                    self.crc_errors += 1
+                    self.resync_bytes += 1
+                    pos += 1
+                    continue
+
+                self.frames += 1
+                self.pos = frame_end
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+            pos = frame_end
+
+        self.pos = pos
+
+# ── RT_DATA Polling ─────────────────────────────────────────────────────────
+# RT_DATA wave block types
+DTYPE_BP_MEASURING  = 0x00
+DTYPE_BP_RESULT     = 0x01
+DTYPE_ECG_MEASURING = 0x02
+DTYPE_ECG_RESULT    = 0x03
+
+class RtPoller:
+    """
+    Response-driven RT_DATA polling.  The next request goes out as soon as
+    the previous reply has been decoded, but no sooner than `interval`
+    after the last request.  Each reply sets that interval: a BP or ECG
+    measurement in progress drops it to `min_interval` so the waveform has
+    no gaps, anything else doubles it up to `idle_interval`.  A reply that never comes is given
+    up on after `timeout` seconds.
+    """
+
+    def __init__(self, min_interval: float = 0.1, idle_interval: float = 2.0, timeout: float = 3.0):
+        self.min_interval = min_interval
+        self.idle_interval = idle_interval
+        self.timeout = timeout
+        self.interval = min_interval
+        self.replied = asyncio.Event()
+        self.requests = 0
+        self.replies = 0
+        self.timeouts = 0
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'replies':  self.replies,
+            'timeouts': self.timeouts,
+            'interval': self.interval,
+        }
+
+    def reply(self, dtype):
+        """Call with parse_rtdata()'s row['dtype'] for each RT_DATA reply"""
+        if dtype in (DTYPE_BP_MEASURING, DTYPE_ECG_MEASURING):
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.idle_interval)
+        self.replies += 1
+        self.replied.set()
+
+    async def run(self, client):
+        """Poll until cancelled"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                self.replied.clear()
+                sent = loop.time()
+                await client.write_gatt_char(WRITE_CHAR_UUID, cmd_get_rt_data())
+                self.requests += 1
+
+                try:
+                    await asyncio.wait_for(self.replied.wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+
+                delay = sent + self.interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            pass
+
+# ── Row Sinks ───────────────────────────────────────────────────────────────
+class RowSink:
+    """
+    Where capture rows go.  A sink is opened once with the column names,
+    keeps its output open for the whole capture and batches rows, writing
+    them out every `flush_rows` rows or `flush_interval` seconds (checked as
+    rows arrive) and on close().  Subclasses implement _open, _write_rows
+    and _close.
+    """
+
+    def __init__(self, filename: str, flush_interval: float = 1.0, flush_rows: int = 256):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.columns = None
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def open(self, columns: list):
+        self.columns = list(columns)
+        self._open()
+
+    def write(self, row: list):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self._write_rows(self.rows)
+            self.rows = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.columns is not None:
+            self.flush()
+            self._close()
+            self.columns = None
+
+class CsvSink(RowSink):
+    """Rows as CSV, with the column names as the first line"""
+
+    def _open(self):
+        self.fp = open(self.filename, 'w', newline='')
+        self.writer = csv.writer(self.fp)
+        self.writer.writerow(self.columns)
+
+    def _write_rows(self, rows):
+        self.writer.writerows(rows)
+        self.fp.flush()
+
+    def _close(self):
+        self.fp.close()
+
+class BinarySink(RowSink):
+    """
+    Fixed size little-endian records: the timestamp (an ISO string in the
+    row) as float64 seconds since the epoch, then an int64 per column, -1
+    where blank.  The file starts with a JSON line of the column names.
+    Every column but the first must be numeric, so wave samples have to
+    go to a WaveformSink.
+    """
+
+    def _open(self):
+        if 'wave_samples' in self.columns:
+            raise ValueError("BinarySink can't store wave_samples, use a wave file")
+        self.record = struct.Struct('<d%dq' % (len(self.columns) - 1))
+        self.fp = open(self.filename, 'wb')
+        self.fp.write(json.dumps(self.columns).encode() + b'\n')
+
+    def _write_rows(self, rows):
+        pack = self.record.pack
+        self.fp.write(b''.join(
+            pack(datetime.fromisoformat(r[0]).timestamp(), *(-1 if v == '' else v for v in r[1:]))
+            for r in rows))
+        self.fp.flush()
+
+    def _close(self):
+        self.fp.close()
+
+class SqliteSink(RowSink):
+    """Rows in an SQLite table (default 'rtdata'), one transaction per batch"""
+
+    def __init__(self, filename: str, table: str = 'rtdata', **kwargs):
+        super().__init__(filename, **kwargs)
+        self.table = table
+
+    def _open(self):
+        self.db = sqlite3.connect(self.filename)
+        cols = ', '.join(f'"{c}"' for c in self.columns)
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS "{self.table}" ({cols})')
+        self.insert = f'INSERT INTO "{self.table}" VALUES ({", ".join("?" * len(self.columns))})'
+
+    def _write_rows(self, rows):
+        with self.db:
+            self.db.executemany(self.insert, [[None if v == '' else v for v in r] for r in rows])
+
+    def _close(self):
+        self.db.close()
+
 # ── Capture Function ─────────────────────────────────────────────────────────
 async def capture_bp2(duration: float = 60.0,
                       scan_timeout: float = 20.0,
-                      csv_filename: str = "bp2.csv"):
+                      csv_filename: str = "bp2.csv",
+                      decoder: FrameDecoder = None,
+                      wave_filename: str = None,
+                      sink: RowSink = None,
+                      poller: RtPoller = None):
     """
     Scans for a BP2 device (timeout=scan_timeout), connects, streams RT_PARAM/RT_DATA
     for `duration` seconds, logs everything to `csv_filename`, and returns:
       (first_bp_reading_dict, csv_filename)
+    Pass a FrameDecoder to read its link quality stats() afterwards.
+    With `wave_filename` the wave samples go to that file through a
+    WaveformSink and the CSV gets wave_offset/wave_count columns instead of
+    the JSON wave_samples.
+    Pass a RowSink (BinarySink, SqliteSink, ...) to log somewhere other than
+    a CsvSink on `csv_filename`; it is opened and closed here.
+    Pass an RtPoller to tune the RT_DATA polling or read its stats().
     """
-    # prepare CSV
-    with open(csv_filename, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            'timestamp','sys','dia','pr',
-            'ecg_duration_ms','ecg_hr','wave_samples'
-        ])
+    sink = sink or CsvSink(csv_filename)
+    poller = poller or RtPoller()
 
     sensor_data = None
-    buffer = bytearray()
+    decoder = decoder or FrameDecoder()
 
     async def handle_notify(_, data: bytes):
-        nonlocal sensor_data, buffer
-        buffer += data
-        i = 0
-        while i + 8 <= len(buffer):
-            if buffer[i] != 0xA5 or (buffer[i+1] ^ buffer[i+2]) != 0xFF:
-                i += 1
-                continue
-            length = buffer[i+5] | (buffer[i+6] << 8)
-            end = i + 8 + length
-            if end > len(buffer):
-                break
-            frame = bytes(buffer[i:end])
-            i = end
-            if frame[-1] != cal_crc8(frame[:-1]):
-                continue
+        nonlocal sensor_data
+        for frame in decoder.feed(data):
             if frame[1] == RT_DATA:
-                row = parse_rtdata(frame[8:-1])
+                row = _parse_rtdata(frame[8:-1], wave_json=wave is None)
+                poller.reply(row['dtype'])
                 ts = datetime.now().isoformat()
                 # first BP
                 if row['sys'] and sensor_data is None:
@@ -154,24 +489,12 @@ async def capture_bp2(duration: float = 60.0,
                         'dia':        row['dia'],
                         'pr':         row['pr'],
                     }
-                # append CSV
-                with open(csv_filename, 'a', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow([
-                        ts,
-                        row['sys'], row['dia'], row['pr'],
-                        row['ecg_duration_ms'], row['ecg_hr'],
-                        row['wave_samples']
-                    ])
-        buffer = buffer[i:]
-
-    async def rt_loop(client):
-        try:
-            while True:
-                await client.write_gatt_char(WRITE_CHAR_UUID, cmd_get_rt_data())
-                await asyncio.sleep(2)
-        except asyncio.CancelledError:
-            pass
+                sink.write([
+                    ts,
+                    row['sys'], row['dia'], row['pr'],
+                    row['ecg_duration_ms'], row['ecg_hr'],
+                ] + (list(wave.write(row['wave'])) if wave else [row['wave_samples']]))
+                row['wave'].release()
 
     # scan
     devices = await BleakScanner.discover(timeout=scan_timeout)
@@ -180,15 +503,26 @@ async def capture_bp2(duration: float = 60.0,
         raise TimeoutError(f"No BP2 discovered in {scan_timeout} seconds")
 
     # connect & stream
-    async with BleakClient(target.address) as client:
-        await client.start_notify(NOTIFY_CHAR_UUID, handle_notify)
-        await client.write_gatt_char(WRITE_CHAR_UUID, cmd_get_rt_param())
-        await asyncio.sleep(1)
-        task = asyncio.create_task(rt_loop(client))
-        await asyncio.sleep(duration)
-        task.cancel()
-        await task
-        await client.stop_notify(NOTIFY_CHAR_UUID)
+    wave = WaveformSink(wave_filename) if wave_filename else None
+    try:
+        sink.open([
+            'timestamp','sys','dia','pr',
+            'ecg_duration_ms','ecg_hr'
+        ] + (['wave_offset','wave_count'] if wave else ['wave_samples']))
+
+        async with BleakClient(target.address) as client:
+            await client.start_notify(NOTIFY_CHAR_UUID, handle_notify)
+            await client.write_gatt_char(WRITE_CHAR_UUID, cmd_get_rt_param())
+            await asyncio.sleep(1)
+            task = asyncio.create_task(poller.run(client))
+            await asyncio.sleep(duration)
+            task.cancel()
+            await task
+            await client.stop_notify(NOTIFY_CHAR_UUID)
+    finally:
+        sink.close()
+        if wave:
+            wave.close()
 
     return sensor_data, csv_filename
 
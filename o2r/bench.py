@@ -0,0 +1,300 @@
+import o2r
+import argparse, asyncio, importlib.util, os, random, struct, tempfile, timeit
+
+# Micro-benchmarks for the hot paths, run with `python3 bench.py [name ...]`
+
+def report( name, secs, count, unit='ops' ):
+    print( '  %-32s %10.0f %s/s  %8.2f us/op' % (name, count / secs, unit, secs * 1e6 / count) )
+
+def best( func, number ):
+    return min( timeit.repeat( func, number=number, repeat=5 ) )
+
+
+# The per-byte checksum o2pkt used before o2crc
+class legacy_crc:
+    def __init__( self ):
+        self.recv_crc = 0
+
+    def _crc_byte( self, b ):
+        chk = self.recv_crc ^ b
+        self.recv_crc = 0
+
+        if chk & 0x01: self.recv_crc = 0x07
+        if chk & 0x02: self.recv_crc ^= 0x0e
+        if chk & 0x04: self.recv_crc ^= 0x1c
+        if chk & 0x08: self.recv_crc ^= 0x38
+        if chk & 0x10: self.recv_crc ^= 0x70
+        if chk & 0x20: self.recv_crc ^= 0xe0
+        if chk & 0x40: self.recv_crc ^= 0xc7
+        if chk & 0x80: self.recv_crc ^= 0x89
+
+    def chksum( self, data ):
+        self.recv_crc = 0
+
+        for i in data:
+            self._crc_byte( i )
+
+        return self.recv_crc
+
+def bench_crc( number ):
+    legacy = legacy_crc()
+    o2r.crc8_words( b'\0\0' ) # build the 16-bit table outside the timing
+
+    # short command, READ_SENSORS reply, CMD_INFO reply, CMD_RT_DATA reply, file block
+    for size in (8, 21, 264, 275, 4096):
+        data = os.urandom( size )
+        assert legacy.chksum( data ) == o2r.crc8( data ) == o2r.crc8_table( data ) == o2r.crc8_words( data )
+        n = max( 10, number * 64 // size )
+
+        print( 'crc8 over %d bytes' % size )
+        report( 'legacy per-byte', best( lambda: legacy.chksum( data ), n ), n )
+        report( 'crc8_table', best( lambda: o2r.crc8_table( data ), n ), n )
+        report( 'crc8_words', best( lambda: o2r.crc8_words( data ), n ), n )
+        report( 'crc8', best( lambda: o2r.crc8( data ), n ), n )
+
+# o2pkt.recv as it was before o2framer, reassembling with +=
+class legacy_pkt( legacy_crc ):
+    def __init__( self ):
+        super().__init__()
+        self.recv_buf = ""
+        self.recv_want = None
+
+    def chksum( self, data ):
+        return o2r.crc8( data )
+
+    def recv( self, data ):
+        if self.recv_want is None:
+            if( len(data) < 8 ):
+                raise EOFError("Receive didn't return enough data")
+
+            (src, self.recv_cmd, ncmd, self.recv_block, self.recv_want) = struct.unpack( '<BBBHH', data[:7] )
+
+            if( src != 0x55 ):
+                raise TypeError("Packet not from ring")
+
+            if( self.recv_cmd != (ncmd ^ 0xFF) ):
+                raise KeyError("Command Check Failed")
+
+            self.recv_buf = data
+            self.recv_want += 8
+        else:
+            self.recv_buf += data
+
+        if( len(self.recv_buf) < self.recv_want ):
+            return False
+
+        if( len(self.recv_buf) != self.recv_want ):
+            raise BufferError("Got more data than expected")
+
+        if( self.chksum(self.recv_buf[:-1]) != self.recv_buf[-1] ):
+            raise ValueError("Checksum Failed!")
+
+        self.recv_data = self.recv_buf[7:-1]
+        return True
+
+def make_frame( size ):
+    out = struct.pack( '<BBBHH', 0x55, 0, 0xFF, 0, size ) + os.urandom( size )
+    return out + bytes( [o2r.crc8( out )] )
+
+def bench_frame( number ):
+    # CMD_INFO reply, CMD_RT_DATA reply, a large file block
+    for size in (256, 267, 4096):
+        frame = make_frame( size )
+        chunks = [ frame[i:i+20] for i in range( 0, len(frame), 20 ) ]
+        n = max( 10, number * 64 // size )
+
+        # packets are made outside the timing, only reassembly and the CRC check are measured
+        old_pkt = legacy_pkt()
+        def legacy():
+            old_pkt.recv_want = None
+            for c in chunks:
+                old_pkt.recv( c )
+
+        pkt = o2r.o2pkt( o2r.CMD_INFO )
+        def framer():
+            for c in chunks:
+                pkt.recv( c )
+
+        shared = o2r.o2framer()
+        def device():
+            # what O2BTDevice does, one long-lived framer handing frames to recv_frame
+            for c in chunks:
+                for frame in shared.feed( c ):
+                    pkt.recv_frame( frame )
+
+        print( 'o2pkt.recv of a %d byte payload from %d notifications' % (size, len(chunks)) )
+        report( 'legacy +=', best( legacy, n ), n )
+        report( 'o2framer', best( framer, n ), n )
+        report( 'o2framer, O2BTDevice path', best( device, n ), n )
+
+def make_vld( fname, count, resolution=4 ):
+    """ Write a synthetic vld3 file of count records """
+    size = 40 + count * 5
+    duration = count * resolution
+    header = struct.pack( '<HHBBBBBHHHHBBBBBHBB', 3, 2025, 1, 1, 23, 0, 0, size & 0xFFFF, size >> 16, duration & 0xFFFF, duration >> 16, 95, 88, 3, 1, 0, 0, 0, 0 )
+    recs = bytes( random.choice( (96, 97, 0xFF) ) if i % 5 == 0 else random.randrange( 2 ) for i in range( count * 5 ) )
+    with open( fname, 'wb' ) as fp:
+        fp.write( header.ljust( 40, b'\0' ) + recs )
+
+def check_vld_roundtrip( tmp ):
+    """ Read a 20 hour file, longer than the 16 bit duration field, write it back and compare """
+    count = 20 * 3600 // 4
+    fname = os.path.join( tmp, 'long.vld' )
+    copy = os.path.join( tmp, 'copy.vld' )
+    make_vld( fname, count )
+
+    with o2r.o2filereadbin( fname ) as f:
+        assert f.header['duration'] == count * 4 and f.header['resolution'] == 4.0
+        cols = f.to_arrays()
+        out = o2r.o2filewritebin( copy )
+        for rec in f.records():
+            out.writerow( rec )
+        out.close()
+
+    with o2r.o2filereadbin( copy ) as f:
+        assert f.header['duration'] == count * 4 and f.header['filesize'] == 40 + count * 5
+        again = f.to_arrays()
+
+    for name in cols:
+        assert (cols[name] == again[name]).all(), name
+
+def bench_vld( number ):
+    # one night at 4s resolution
+    count = 8 * 3600 // 4
+    with tempfile.TemporaryDirectory() as tmp:
+        check_vld_roundtrip( tmp )
+        fname = os.path.join( tmp, 'night.vld' )
+        make_vld( fname, count )
+        n = max( 1, number // 1000 )
+
+        def records():
+            with o2r.o2filereadbin( fname ) as f:
+                for rec in f.records():
+                    pass
+
+        def arrays():
+            with o2r.o2filereadbin( fname ) as f:
+                f.to_arrays()
+
+        print( 'read a %d record vld3 file' % count )
+        report( 'records()', best( records, n ), n * count, 'recs' )
+        report( 'to_arrays()', best( arrays, n ), n * count, 'recs' )
+
+def legacy_packetify( pkt ):
+    """ o2pkt.packetify before the packet cache, pack and checksum every time """
+    return pkt._pack()
+
+def legacy_build_cmd( opcode, seq ):
+    """ bp2 build_cmd before the cached commands """
+    pkt = bytes( [0xA5, opcode, (~opcode) & 0xFF, 0x00, seq, 0, 0] )
+    return pkt + bytes( [o2r.crc8( pkt )] )
+
+def load_bp2():
+    """ bp2/function.py, loaded by path as it isn't a package """
+    path = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'bp2', 'function.py' )
+    spec = importlib.util.spec_from_file_location( 'bp2_function', path )
+    mod = importlib.util.module_from_spec( spec )
+    spec.loader.exec_module( mod )
+    return mod
+
+def bench_build( number ):
+    n = number * 50
+    pkts = (
+        ('CMD_READ_SENSORS', o2r.o2pkt( o2r.CMD_READ_SENSORS )),
+        ('CMD_RT_DATA', o2r.o2pkt( o2r.CMD_RT_DATA, long=True )),
+    )
+
+    for (name, pkt) in pkts:
+        assert pkt.packetify() == legacy_packetify( pkt )
+        print( 'build %s' % name )
+        report( 'pack + crc8', best( lambda: legacy_packetify( pkt ), n ), n, 'builds' )
+        report( 'o2pkt.packetify', best( pkt.packetify, n ), n, 'builds' )
+
+    # bp2 RT_DATA request, only the sequence number changes
+    bp2 = load_bp2()
+    bp2._seq_no = 77
+    assert bp2.build_cmd( bp2.RT_DATA ) == legacy_build_cmd( bp2.RT_DATA, 77 )
+    print( 'build bp2 RT_DATA with a sequence number' )
+    report( 'pack + crc8', best( lambda: legacy_build_cmd( 0x08, 77 ), n ), n, 'builds' )
+    report( 'build_cmd', best( lambda: bp2.build_cmd( bp2.RT_DATA ), n ), n, 'builds' )
+
+# A 7.5-50ms connection interval is typical.  Each acknowledged write waits
+# out at least one interval for its response, unacknowledged ones share them.
+CONN_INTERVAL = 0.030
+PER_EVENT = 4
+
+class bench_device( o2r.O2BTDevice ):
+    """ Just enough of a connected O2BTDevice for _go_send, counting the writes """
+    name = 'bench'
+    address = 'bench'
+    is_connected = True
+
+    def __init__( self, write_size, write_response ):
+        self.manager = o2r.O2DeviceManager.__new__( o2r.O2DeviceManager )
+        self.manager.verbose = 0
+        self.disconnect_pending = False
+        self.write = None
+        self.write_size = write_size
+        self.write_response = write_response
+        self.writes = []
+
+    async def write_gatt_char( self, char, data, response=None ):
+        self.writes.append( (len(data), response) )
+
+    def link_time( self ):
+        """ Modelled air time of the writes so far """
+        acked = sum( 1 for (n, r) in self.writes if r )
+        unacked = len(self.writes) - acked
+        return (acked + -(-unacked // PER_EVENT)) * CONN_INTERVAL
+
+def bench_send( number ):
+    loop = asyncio.new_event_loop()
+
+    config = { 'SetOxiThr': 90, 'SetOxiSwitch': 1, 'SetHRSwitch': 1, 'SetHRLowThr': 50, 'SetHRHighThr': 120,
+        'SetMotor': 60, 'SetLightingMode': 2, 'SetLightStr': 1, 'SetTIME': '2025-01-01,23:00:00' }
+    packets = (
+        ('CMD_FILE_OPEN', o2r.o2pkt( o2r.CMD_FILE_OPEN, data='20250101230000' + chr(0) )),
+        ('CMD_CONFIG', o2r.o2cmd.SetConfig( config )),
+    )
+
+    # (name, bytes per write, acknowledged), 20 acknowledged bytes is how it used to be sent
+    paths = (
+        ('20 byte writes w/ response', 20, True),
+        ('MTU 185 w/ response', 182, True),
+        ('MTU 247 w/o response', 244, False),
+    )
+
+    for (cmd, pkt) in packets:
+        buf = pkt.packetify()
+        print( '_go_send of a %d byte %s' % (len(buf), cmd) )
+
+        for (name, size, response) in paths:
+            dev = bench_device( size, response )
+            loop.run_until_complete( dev._go_send( buf ) )
+            (writes, link) = (len(dev.writes), dev.link_time())
+
+            report( name, best( lambda: loop.run_until_complete( dev._go_send( buf ) ), number ), number )
+            print( '  %-32s %10d writes  %8.1f ms on the link (modelled)' % ('', writes, link * 1e3) )
+
+    loop.close()
+
+BENCHES = {
+    'crc': bench_crc,
+    'frame': bench_frame,
+    'vld': bench_vld,
+    'send': bench_send,
+    'build': bench_build,
+}
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="o2r micro-benchmarks")
+    arg_parser.add_argument( '-n', '--number', type=int, default=2000, help='Base iteration count' )
+    arg_parser.add_argument( 'bench', nargs='*', help='Benchmarks to run (default: all of %s)' % ', '.join(BENCHES) )
+    args = arg_parser.parse_args()
+
+    for name in args.bench:
+        if( name not in BENCHES ):
+            arg_parser.error( 'unknown benchmark %s' % name )
+
+    for name in (args.bench or BENCHES):
+        BENCHES[name]( args.number )
@@ -1,48 +1,111 @@
 import o2r
-import csv, argparse, os
+import csv, argparse, os, time
+import concurrent.futures
+
+def convert( fname, want, force, compress=False ):
+    """
+    Convert one file, returns (status, outname, message).  Output goes to a
+    temporary file which is only renamed into place once it is complete, so a
+    failure never leaves a partial output file behind.
+    """
+    infile = o2r.o2fileread( fname )
+
+    if( infile is None ):
+        return ('error', None, 'Skipping %s: unknown file type' % fname)
+
+    if( want ):
+        oftype = want
+    elif( infile.ftype == 'csv' ):
+        oftype = 'vld'
+    else:
+        oftype = 'csv'
+
+    if( fname[-4] == '.' ):
+        outname = fname[:-3] + oftype
+    else:
+        outname = fname + '.' + oftype
+
+    if( (not force) and os.path.exists( outname ) ):
+        infile.close()
+        return ('skip', outname, 'Skipping %s: output file %s already exists' % (fname, outname))
+
+    tmpname = outname + '.tmp'
+    start = time.monotonic()
+    count = 0
+    done = False
+
+    try:
+        outfile = o2r.o2filewrite( tmpname, oftype, header=infile.header, compress=compress )
+
+        try:
+            if( hasattr( infile, 'to_arrays' ) and hasattr( outfile, 'write_arrays' ) ):
+                # both ends columnar, skip the per-record dicts
+                cols = infile.to_arrays()
+                outfile.write_arrays( cols )
+                count = len(cols['spo2'])
+            else:
+                for rec in infile.records():
+                    outfile.writerow( rec )
+                    count += 1
+        finally:
+            outfile.close()
+
+        os.replace( tmpname, outname )
+        done = True
+    finally:
+        infile.close()
+        if( not done and os.path.exists( tmpname ) ):
+            os.remove( tmpname )
+
+    secs = max( time.monotonic() - start, 1e-6 )
+    return ('done', outname, 'Converted %s (type: %s) to %s (type: %s): %d records in %.2fs, %.0f records/s' % (fname, infile.ftype, outname, oftype, count, secs, count / secs))
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description="O2Ring Data Converter", epilog='If neither --csv nor --bin are provided it will attempt to auto-detect and convert to the opposite' )
     arg_parser.add_argument( '--csv', help='Assume input files are binary and convert them to CSV', action="store_true" )
     arg_parser.add_argument( '--bin', help='Assume input files are CSV and convert them to binary', action="store_true" )
+    arg_parser.add_argument( '--npz', help='Convert input files to NumPy columns (.npz)', action="store_true" )
+    arg_parser.add_argument( '--compress', help='Compress --npz output', action="store_true" )
     arg_parser.add_argument( '--force', help='Overwrite output file if it exists', action="store_true" )
+    arg_parser.add_argument( '-j', '--jobs', help='Number of files to convert in parallel (default: 1, 0 for one per CPU)', type=int, default=1 )
     arg_parser.add_argument( 'file', help='File(s) to convert', action='append', nargs='+' )
     args = arg_parser.parse_args()
 
     #print(args)
 
-    if( (not args.csv) and (not args.bin) ):
-        pass
+    if( args.csv ):
+        want = 'csv'
+    elif( args.bin ):
+        want = 'vld'
+    elif( args.npz ):
+        want = 'npz'
+    else:
+        want = None
 
-    for fname in args.file[0]:
-        infile = o2r.o2fileread( fname )
+    files = args.file[0]
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    counts = { 'done': 0, 'skip': 0, 'error': 0 }
+    start = time.monotonic()
 
-        if( args.csv ):
-            oftype = 'csv'
-        elif( args.bin ):
-            oftype = 'vld'
-        else:
-            if( infile.ftype == 'csv' ):
-                oftype = 'vld'
-            else:
-                oftype = 'csv'
+    def finished( fname, job ):
+        try:
+            (status, outname, msg) = job()
+        except Exception as e:
+            (status, msg) = ('error', 'Failed to convert %s: %s' % (fname, repr(e)))
 
-        if( fname[-4] == '.' ):
-            outname = fname[:-3] + oftype
-        else:
-            outname = fname + '.' + oftype
+        counts[status] += 1
+        print( '[%d/%d] %s' % (sum(counts.values()), len(files), msg) )
 
-        if( (not args.force) and os.path.exists( outname ) ):
-            print( 'Skipping %s: output file %s already exists' % (fname, outname) )
-            continue
+    if( jobs == 1 or len(files) < 2 ):
+        for fname in files:
+            finished( fname, lambda: convert( fname, want, args.force, args.compress ) )
+    else:
+        with concurrent.futures.ProcessPoolExecutor( max_workers=min( jobs, len(files) ) ) as pool:
+            futures = { pool.submit( convert, fname, want, args.force, args.compress ): fname for fname in files }
+            for fut in concurrent.futures.as_completed( futures ):
+                finished( futures[fut], fut.result )
 
-        outfile = o2r.o2filewrite( outname, oftype )
-
-        print( 'Converting %s (type: %s) to %s (type: %s)' % (fname, infile.ftype, outname, outfile.ftype) )
-
-        for rec in infile.records():
-            outfile.writerow( rec )
-
-        infile.close()
-        outfile.close()
+    print( '%d converted, %d skipped, %d failed in %.1fs' % (counts['done'], counts['skip'], counts['error'], time.monotonic() - start) )
 
+    if( counts['error'] ):
+        raise SystemExit( 1 )
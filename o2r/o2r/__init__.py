@@ -2,3 +2,9 @@ from .o2bt import *
 from .o2pkt import *
 from .o2state import *
 from .o2file import *
+from .o2crc import *
+from .o2frame import *
+from .o2log import *
+from .o2ppg import *
+from .o2clock import *
+from .o2gatt import *
@@ -15,6 +15,14 @@ CMD_FILE_OPEN = 3 # rx len = 12, tx filename length and filename
 CMD_FILE_READ = 4 # tx block number
 CMD_FILE_CLOSE = 5 # tx no data
 
+#Command priorities in O2BTDevice, lower numbers go first
+PRIO_REALTIME = 0
+PRIO_CONFIG = 1
+PRIO_FILE = 2
+PRIO_NAMES = { PRIO_REALTIME: 'realtime', PRIO_CONFIG: 'config', PRIO_FILE: 'file' }
+# anything not listed is PRIO_CONFIG
+CMD_PRIORITY = { CMD_READ_SENSORS: PRIO_REALTIME, CMD_RT_DATA: PRIO_REALTIME, CMD_FILE_OPEN: PRIO_FILE, CMD_FILE_READ: PRIO_FILE, CMD_FILE_CLOSE: PRIO_FILE }
+
 # Additional commands discoverable at 
 # https://github.com/viatomEcho/LepuBle/blob/2db64621969b436fcef5da992bd8728d72513b10/blepro/src/main/java/com/lepu/blepro/ble/cmd/OxyBleCmd.java#L19
 
@@ -1,5 +1,7 @@
 import struct
-import queue
+import collections
+import random
+import time
 
 from .defines import *
 
@@ -7,48 +9,215 @@ from bleak import BleakScanner, BleakClient
 import asyncio
 import functools
 from .o2pkt import o2pkt
+from .o2frame import o2framer
 
 class O2BTDevice(BleakClient):
 
-  def busy(self):
-    return self.pkt is not None
+  def busy(self, priority=None):
+    """ Anything queued or in flight, or only at the given priority """
+    if priority is None:
+      return len(self.inflight) > 0 or any(self.queues.values())
+
+    return len(self.queues[priority]) > 0 or any(p.priority == priority for p in self.inflight)
+
+  def depths(self):
+    """ Queued commands by priority name, and how many are in flight """
+    d = {PRIO_NAMES[p]: len(q) for p, q in self.queues.items()}
+    d["inflight"] = len(self.inflight)
+    return d
 
   def send_packet(self, pkt):
-    self.pkt_queue.put(pkt)
-    self._start_packet()
+    self.queues[pkt.priority].append(pkt)
+    self.wakeup.set()
+
+    if self.sender is None:
+      self.sender = asyncio.ensure_future(self._sender())
+
+  def cancel(self, cmd):
+    """
+    Drop queued cmd packets, and let those in flight go without retrying
+    or delivering them.  They stay in flight until answered or timed out,
+    so a late reply can't be taken for the next command's.
+    """
+    for q in self.queues.values():
+      for pkt in [p for p in q if p.cmd == cmd]:
+        q.remove(pkt)
+
+    for pkt in self.inflight:
+      if pkt.cmd == cmd:
+        pkt.cancelled = True
+
+  def _can_start(self, pkt):
+    if not self.inflight:
+      return True
+
+    # replies don't say which command they answer, only block reads can be
+    #  told apart (by block number), so only they are pipelined, and only
+    #  behind other block reads; otherwise a lost reply would hand every
+    #  later reply to the wrong command
+    if pkt.cmd != CMD_FILE_READ or len(self.inflight) >= self.window:
+      return False
+
+    return all(p.cmd == CMD_FILE_READ for p in self.inflight)
+
+  def _pick(self):
+    # highest priority first, but a lower priority passed over self.fair
+    #  times in a row gets the next slot so file blocks keep trickling
+    #  through a busy realtime stream
+    ready = [p for p in sorted(self.queues) if self.queues[p] and self._can_start(self.queues[p][0])]
+    if not ready:
+      return None
+
+    prio = ready[0]
+    for p in reversed(ready[1:]):
+      if self.skipped[p] >= self.fair:
+        prio = p
+        break
+
+    for p in ready:
+      self.skipped[p] = 0 if p == prio else self.skipped[p] + 1
+
+    return self.queues[prio].popleft()
+
+  async def _sender(self):
+    # the one task writing to the ring, so packets never interleave on the wire
+    try:
+      while not self.disconnect_pending and self.is_connected:
+        pkt = self._pick()
+        if pkt is None:
+          self.wakeup.clear()
+          await self.wakeup.wait()
+          continue
+
+        self.inflight.append(pkt)
+        pkt.tries += 1
+        pkt.timer = asyncio.get_event_loop().call_later(self.timeout, self._timed_out, pkt)
+        pstr = pkt.packetify()
+
+        if self.manager.verbose > 3:
+          print(f"[{self.name}] Sending {pstr.hex()}")
+
+        try:
+          await self._go_send(pstr)
+        except Exception as e:
+          # the write itself failed (ATT error etc), so wait as for a lost
+          #  reply before resending, longer each time, rather than hammer
+          #  a failing link
+          self.counters["write_errors"] += 1
+          pkt.timer.cancel()
+          delay = min(self.timeout * 2 ** (pkt.tries - 1), self.manager.backoff_max)
+          pkt.timer = asyncio.get_event_loop().call_later(delay, self._write_failed, pkt, f"write failed: {e!r}")
+    finally:
+      self.sender = None
+
+  def _match_reply(self, frame):
+    # block reads may be answered out of order, match them up by block number
+    if self.inflight[0].cmd == CMD_FILE_READ:
+      (block,) = struct.unpack_from('<H', frame, 3)
+      for pkt in self.inflight:
+        if pkt.cmd == CMD_FILE_READ and pkt.block == block:
+          self.inflight.remove(pkt)
+          return pkt
+
+      # a block nobody is waiting for
+      return None
+
+    return self.inflight.popleft()
+
+  def _timed_out(self, pkt):
+    if pkt not in self.inflight:
+      return
+
+    self.inflight.remove(pkt)
+    self.counters["timeouts"] += 1
+
+    # whatever part of its reply has come in is no use now, but with block
+    #  reads pipelined the partial frame may be another block's, keep that
+    owner = self.framer.block
+    if owner is None or not any(p.cmd == CMD_FILE_READ and p.block == owner for p in self.inflight):
+      self.framer.reset()
 
-  def _start_packet(self):
-    if self.pkt is None:
+    self._retry(pkt, "timed out")
+
+  def _write_failed(self, pkt, why):
+    # kept in flight until now so nothing else went out in its place
+    if pkt not in self.inflight:
+      return
+
+    self.inflight.remove(pkt)
+    self._retry(pkt, why)
+
+  def _retry(self, pkt, why):
+    # resend pkt as it was (same block), ahead of anything else at its priority
+    if pkt.cancelled:
+      # no longer wanted, see cancel()
+      pass
+    elif pkt.tries > self.retries:
+      self.counters["failed"] += 1
+      print(f"[{self.name}] Giving up on command {pkt.cmd} block {pkt.block} after {pkt.tries} tries: {why}")
+      self.manager.queue.put_nowait((self.mac_address, "FAILED", pkt))
+    else:
+      self.counters["retries"] += 1
+      if self.manager.verbose > 1:
+        print(f"[{self.name}] Resending command {pkt.cmd} block {pkt.block}: {why}")
+      self.queues[pkt.priority].appendleft(pkt)
+
+    self.wakeup.set()
+    if self.sender is None and not self.disconnect_pending and self.is_connected:
+      self.sender = asyncio.ensure_future(self._sender())
+
+  async def _go_setup_write(self):
+    # size the writes to the link, and skip the per-write acknowledgement when the characteristic allows it
+    backend = getattr(self, "_backend", None)
+    if backend is not None and hasattr(backend, "_acquire_mtu") and getattr(backend, "_mtu_size", 0) is None:
+      # BlueZ only reports the negotiated MTU once asked for it
       try:
-        self.pkt = self.pkt_queue.get(False)
-      except:
-        return
+        await backend._acquire_mtu()
+      except Exception as e:
+        if self.manager.verbose > 1:
+          print(f"[{self.name}] Couldn't get the MTU, assuming the default: {e!r}")
+
+    self.write_response = self.manager.write_response or "write-without-response" not in self.write.properties
 
-      pstr = self.pkt.packetify()
+    if self.manager.write_size:
+      self.write_size = self.manager.write_size
+    elif not self.write_response:
+      self.write_size = self.write.max_write_without_response_size
+    else:
+      # ATT write request header is 3 bytes
+      self.write_size = self.mtu_size - 3
 
-      if self.manager.verbose > 3:
-        print(f"[{self.name}] Sending {pstr.hex()}")
+    # 20 always fits the default 23 byte MTU
+    self.write_size = max(20, self.write_size)
 
-      asyncio.ensure_future(self._go_send(pstr))
+    if self.manager.verbose > 1:
+      print(f"[{self.name}] Writing {self.write_size} byte chunks {'with' if self.write_response else 'without'} response")
 
   async def _go_send(self, buf):
-    if self.disconnect_pending or not self.is_connected:
-      return
+    # only ever called from _sender, so the chunks of one packet go out back to back and in order
+    for i in range(0, len(buf), self.write_size):
+      if self.disconnect_pending or not self.is_connected:
+        return
 
-    await self.write_gatt_char(self.write, buf[:20])
+      await self.write_gatt_char(self.write, buf[i:i+self.write_size], response=self.write_response)
 
     if self.manager.verbose > 4:
       print(f"[{self.name}] Characteristic {self.write.uuid} write value performed")
 
-    if len(buf) > 20:
-      asyncio.ensure_future(self._go_send(buf[20:]))
-
   async def _go_get_services(self):
     if self.disconnect_pending or not self.is_connected:
       return
 
     # services = await self.get_services()
 
+    cached = self._cached_characteristics()
+    if cached is not None:
+      (read, self.write) = cached
+      if self.manager.verbose > 1:
+        print(f"[{self.name}] Using cached handles: read {read.handle}, write {self.write.handle}")
+      await self._go_enable_notifications(read)
+      return
+
     if self.manager.verbose > 1:
       print(f"[{self.name}] Resolved services")
       for service in self.services:
@@ -59,35 +228,86 @@ class O2BTDevice(BleakClient):
             value = await self.read_gatt_descriptor(descriptor.handle)
             print(f"[{self.name}]\t\t\tDescriptor [{descriptor.uuid}] ({value})")
 
+    read = None
     for s in self.services:
       if s.uuid == BLE_SERVICE_UUID:
         for c in s.characteristics:
           if c.uuid == BLE_READ_UUID:
+            read = c
             asyncio.ensure_future(self._go_enable_notifications(c))
           elif c.uuid == BLE_WRITE_UUID:
             self.write = c
 
+    if self.manager.gatt_cache is not None and read is not None and self.write is not None:
+      self.manager.gatt_cache.put(self.mac_address, BLE_SERVICE_UUID, read, self.write)
+
+  def _cached_characteristics(self):
+    # (read, write) characteristics from the handle cache, or None to do a full walk
+    cache = self.manager.gatt_cache
+    entry = cache.get(self.mac_address) if cache is not None else None
+    if entry is None:
+      return None
+
+    try:
+      found = []
+      for (handle, uuid) in (entry["read"], entry["write"]):
+        c = self.services.get_characteristic(handle)
+        if c is None or c.uuid != uuid or c.service_uuid != entry["service"]:
+          raise KeyError(handle)
+        found.append(c)
+      return tuple(found)
+    except (KeyError, TypeError, ValueError):
+      # the ring's layout changed (firmware update?) or the entry is junk
+      print(f"[{self.name}] Cached GATT handles don't match, rediscovering")
+      cache.drop(self.mac_address)
+      return None
+
   async def _go_enable_notifications(self, characteristic):
     async def on_characteristic_value_updated(sender, value):
       if self.manager.verbose > 4:
         print(f"[{self.name}] Characteristic {characteristic.uuid} updated: {value}")
 
-      if self.pkt is None:
-        print(f"[{self.name}] Received unexpected data! {value} {characteristic}")
-        return
-
-      res = self.pkt.recv( value )
-      if res is False: # waiting for more data
-        if self.manager.verbose > 4:
-          print(f"[{self.name}] Need more data")
-        return
-
-      if self.manager.verbose > 3:
-        print(f"[{self.name}] Final recv: {self.pkt.recv_buf.hex()}")
-
-      self.manager.queue.put_nowait((self.mac_address, "BTDATA", self.pkt))
-      self.pkt = None
-      self._start_packet()
+      # one notification can finish a reply and start the next one
+      frames = self.framer.feed( value )
+      if self.framer.error is not None:
+        # not a reply header (the framer has dropped the rest of the
+        #  notification), a lost command times out and is sent again
+        self.counters["frame_errors"] += 1
+        if self.manager.verbose > 1:
+          print(f"[{self.name}] Bad frame: {self.framer.error}")
+        self.framer.error = None
+
+      for frame in frames:
+        if not self.inflight:
+          print(f"[{self.name}] Received unexpected data! {frame.hex()} {characteristic}")
+          continue
+
+        pkt = self._match_reply( frame )
+        if pkt is None:
+          # the late reply to a block read that has already been resent
+          self.counters["stale"] += 1
+          continue
+
+        pkt.timer.cancel()
+        if pkt.cancelled:
+          self.wakeup.set()
+          continue
+
+        try:
+          pkt.recv_frame( frame )
+        except ValueError as e:
+          self.counters["crc_errors"] += 1
+          self._retry(pkt, str(e))
+          continue
+
+        if self.manager.verbose > 3:
+          print(f"[{self.name}] Final recv: {pkt.recv_buf.hex()}")
+
+        self.manager.queue.put_nowait((self.mac_address, "BTDATA", pkt))
+        self.wakeup.set()
+
+      if self.framer.pending() and self.manager.verbose > 4:
+        print(f"[{self.name}] Need more data")
 
     if self.disconnect_pending or not self.is_connected:
       return
@@ -97,15 +317,38 @@ class O2BTDevice(BleakClient):
     if self.manager.verbose > 3:
       print(f"[{self.name}] Characteristic {characteristic.uuid} enabled notifications")
 
+    await self._go_setup_write()
+
+    if self.manager.verbose > 1 and self.connect_started is not None:
+      print(f"[{self.name}] Ready {time.monotonic() - self.connect_started:.2f}s after connecting")
+
+    if self.lost_at is not None:
+      latency = time.monotonic() - self.lost_at
+      self.lost_at = None
+      self.reconnect_latency.append(latency)
+      print(f"[{self.name}] Reconnected after {latency:.1f}s ({self.counters['reconnect_attempts']} attempts so far)")
+
+    if self.sender is None and self.busy():
+      # commands queued while the link was down
+      self.sender = asyncio.ensure_future(self._sender())
+
     self.manager.queue.put_nowait((self.mac_address, "READY",
       {"name": self.name, "mac": self.address, "self": self, "verbose": self.manager.verbose,
-      "send": self.send_packet, "busy": self.busy, "disconnect": self.disconnect }))
+      "send": self.send_packet, "busy": self.busy, "disconnect": self.disconnect, "cancel": self.cancel,
+      "window": self.window, "depths": self.depths, "counters": self.counters,
+      "write_size": self.write_size }))
 
   async def _go_connect(self):
     if self.is_connected:
       return
 
-    if await super().connect():
+    kwargs = {}
+    if self.manager.gatt_cache is not None and self.manager.gatt_cache.get(self.mac_address) is not None:
+      # BlueZ can then skip its own service discovery too, our handles are checked against what it returns
+      kwargs["dangerous_use_bleak_cache"] = True
+
+    self.connect_started = time.monotonic()
+    if await super().connect(**kwargs):
       print(f"[{self.name}] Connected")
       asyncio.ensure_future(self._go_get_services())
     else:
@@ -116,6 +359,8 @@ class O2BTDevice(BleakClient):
     asyncio.ensure_future(self._go_connect())
 
   async def disconnect_async(self):
+    # on purpose, so no reconnecting
+    self.disconnect_pending = True
     if not self.is_connected:
       return
 
@@ -130,15 +375,72 @@ class O2BTDevice(BleakClient):
 
   def on_disconnect(self):
     print(f"[{self.address}] Disconnected")
+    if any(self.counters.values()):
+      print(f"[{self.address}] Link: {self.counters}")
+
+    # nothing in flight will be answered now
+    for pkt in self.inflight:
+      pkt.timer.cancel()
+    self.inflight.clear()
+    for q in self.queues.values():
+      q.clear()
+    self.framer.reset()
+    self.wakeup.set()
+
+    if not self.disconnect_pending:
+      self.manager.on_lost(self)
     
 
 # also see https://stackoverflow.com/questions/51762227/how-to-call-a-async-function-from-a-synchronized-code-python
 class O2DeviceManager:
   def __init__(self):
+    self.window = 1
+    self.fair = 4
+    self.timeout = 3.0
+    self.retries = 3
+    self.reconnect = True
+    self.backoff_base = 1.0
+    self.backoff_max = 60.0
+    self.gatt_cache = None
+    self.write_size = 0         # 0 to size writes from the MTU
+    self.write_response = False # True to always wait for each write to be acknowledged
     self.pipe_down = []
     self.devices = {}
     self.scanner = BleakScanner(detection_callback=self.on_detection)
 
+  def on_lost(self, dev):
+    # the link dropped without us asking, the state machine is kept for when it is back
+    dev.lost_at = time.monotonic()
+    dev.counters["drops"] += 1
+    self.queue.put_nowait((dev.mac_address, "LOST", dev))
+
+    if self.reconnect and dev.reconnect_task is None:
+      dev.reconnect_task = asyncio.ensure_future(self._reconnect(dev))
+
+  async def _reconnect(self, dev):
+    # exponential backoff with jitter, so rings dropping together don't retry in lockstep
+    attempt = 0
+    try:
+      while not dev.disconnect_pending and not dev.is_connected:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+        if dev.disconnect_pending:
+          break
+
+        dev.counters["reconnect_attempts"] += 1
+        if self.verbose > 1:
+          print(f"[{dev.name}] Reconnect attempt {attempt}")
+
+        try:
+          await dev._go_connect()
+        except Exception as e:
+          if self.verbose > 1:
+            print(f"[{dev.name}] Reconnect failed: {e!r}")
+    finally:
+      dev.reconnect_task = None
+
   async def start_discovery(self):
     await self.scanner.start()
 
@@ -171,16 +473,37 @@ class O2DeviceManager:
 
       print(f"Adding device {device.address}")
 
-      dev = O2BTDevice(address_or_ble_device=device, timeout=20.0, disconnected_callback=O2BTDevice.on_disconnect)
+      kwargs = {}
+      if self.gatt_cache is not None and self.gatt_cache.get(device.address) is not None:
+        # only the ring's own service needs resolving
+        kwargs["services"] = [self.gatt_cache.get(device.address)["service"]]
+
+      dev = O2BTDevice(address_or_ble_device=device, timeout=20.0, disconnected_callback=O2BTDevice.on_disconnect, **kwargs)
       dev.mac_address = device.address
       dev.manager = self
       dev.name = name
       dev.notified = False
       dev.rssi = device.rssi if device.rssi is not None else -999
       dev.write = None
+      dev.write_size = 20
+      dev.write_response = True
       dev.disconnect_pending = False
-      dev.pkt = None
-      dev.pkt_queue = queue.Queue()
+      dev.inflight = collections.deque()
+      dev.window = max(1, self.window)
+      dev.framer = o2framer()
+      dev.queues = {p: collections.deque() for p in PRIO_NAMES}
+      dev.skipped = {p: 0 for p in PRIO_NAMES}
+      dev.fair = self.fair
+      dev.wakeup = asyncio.Event()
+      dev.sender = None
+      dev.timeout = self.timeout
+      dev.retries = self.retries
+      dev.counters = {"timeouts": 0, "retries": 0, "crc_errors": 0, "frame_errors": 0, "stale": 0, "failed": 0,
+        "write_errors": 0, "drops": 0, "reconnect_attempts": 0}
+      dev.lost_at = None
+      dev.reconnect_latency = []
+      dev.reconnect_task = None
+      dev.connect_started = None
       self.devices[device.address] = dev
 
       dev.connect()
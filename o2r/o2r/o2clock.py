@@ -0,0 +1,68 @@
+import time
+
+class o2clock:
+    """
+    Timestamps for realtime PPG samples.
+
+    Arrival times are kept as integer time.monotonic_ns() values.  add()
+    feeds (sample index, arrival) pairs, where the index is that of the last
+    sample in the packet.  A running least-squares fit of arrival time
+    against sample index then gives every sample an interpolated time,
+    which smooths out BLE delivery jitter.  Until the fit spans
+    min_span seconds the nominal sample period is used.
+
+    The fitted period is the ring's sample clock measured against ours, so
+    it already takes out any drift between the two.  The ring's CurTIME is
+    no help here, at one second resolution it would take hours to measure
+    the drift that well.
+    """
+
+    def __init__( self, sample_rate=125, min_span=10.0 ):
+        self.sample_rate = sample_rate
+        self.min_span = min_span
+
+        # monotonic -> wall clock, taken once so a wall clock step can't move samples
+        self.wall_offset = time.time_ns() - time.monotonic_ns()
+
+        self.first = None       # (sample, mono_ns) the fit is relative to
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.period = None      # ns per sample from the fit
+        self.origin = None      # fitted mono_ns of sample 0 relative to first[1]
+
+    def nominal_period( self ):
+        return 1e9 / self.sample_rate
+
+    def add( self, sample, mono_ns ):
+        """ The samples up to (not including) index sample had arrived by mono_ns """
+        if( self.first is None ):
+            self.first = (sample, mono_ns)
+
+        x = sample - self.first[0]
+        y = mono_ns - self.first[1]
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+
+        d = self.n * self.sxx - self.sx * self.sx
+        if( y >= self.min_span * 1e9 and d > 0 ):
+            self.period = (self.n * self.sxy - self.sx * self.sy) / d
+            self.origin = (self.sy - self.period * self.sx) / self.n
+        else:
+            self.period = None
+
+    def mono_ns( self, sample ):
+        """ Estimated monotonic time of a sample """
+        if( self.first is None ):
+            raise ValueError( 'no packets yet' )
+
+        if( self.period is None ):
+            return self.first[1] + int( (sample + 1 - self.first[0]) * self.nominal_period() )
+
+        return self.first[1] + int( self.origin + (sample + 1 - self.first[0]) * self.period )
+
+    def wall_ns( self, sample ):
+        """ Estimated time of a sample, in ns since the epoch """
+        return self.mono_ns( sample ) + self.wall_offset
@@ -0,0 +1,78 @@
+import sys
+from array import array
+
+# Standard CRC-8-CCITT checksum with 0x07 polynomial and 0x00 seed, as used by
+#  both the O2Ring (0xAA/0x55 framing) and the BP2 (0xA5 framing)
+#  bp2/function.py loads this file on its own, so keep it free of imports
+#  from the rest of the package
+
+def _make_table():
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[i] = crc
+    return bytes(table)
+
+CRC8_TABLE = _make_table()
+
+# 16-bit table indexed by a little-endian word (first byte in the low half)
+#  XORed with the running CRC, so two bytes are folded in per lookup.
+#  Built on first use as it is 64k.
+_table16 = None
+
+def _make_table16():
+    global _table16
+    t = CRC8_TABLE
+    _table16 = bytes( t[t[w & 0xFF] ^ (w >> 8)] for w in range(0x10000) )
+    return _table16
+
+def crc8_table( data, crc=0 ):
+    """ Byte-at-a-time table lookup, fastest for short buffers """
+    t = CRC8_TABLE
+    for b in data:
+        crc = t[crc ^ b]
+    return crc
+
+def crc8_words( data, crc=0 ):
+    """ Word-at-a-time lookup using the 16-bit table, for long buffers """
+    t = _table16 or _make_table16()
+    n = len(data)
+    words = array( 'H' )
+    words.frombytes( memoryview(data)[:n & ~1] )
+    if( sys.byteorder != 'little' ):
+        words.byteswap()
+
+    for w in words:
+        crc = t[crc ^ w]
+
+    if( n & 1 ):
+        crc = CRC8_TABLE[crc ^ data[-1]]
+
+    return crc
+
+# below this many bytes building the word array costs more than it saves
+WORDS_MIN_LEN = 128
+
+def crc8( data, crc=0 ):
+    """
+    CRC-8 of a bytes-like object.  Pass a previous result as crc to continue
+    a checksum over several buffers.
+    """
+    if( len(data) < WORDS_MIN_LEN ):
+        return crc8_table( data, crc )
+    return crc8_words( data, crc )
+
+def crc8_shift_table( tail ):
+    """
+    CRC-8 of each byte value followed by tail zero bytes.  With a zero seed
+    and no final XOR the CRC is linear, so for equal length buffers
+    crc8(a ^ b) == crc8(a) ^ crc8(b).  Changing one byte from 0 to v with
+    tail bytes after it therefore flips the CRC by table[v].
+    """
+    t = CRC8_TABLE
+    out = bytearray( t )
+    for _ in range( tail ):
+        out = bytearray( t[c] for c in out )
+    return bytes( out )
@@ -1,8 +1,24 @@
-import struct, os, time, datetime, csv
+import struct, os, time, datetime, csv, mmap, math
+import collections, json
+from array import array
 from collections import namedtuple
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from .defines import *
 
+ViatomRecord = namedtuple( 'ViatomRecord', 'spo2 heartrate oximetry_invalid motion vibration' )
+RECORD_v3 = struct.Struct( '<BB?BB' )
+
+# columns of an .npz file besides time, in record order
+NPZ_FIELDS = ViatomRecord._fields
+
+# the same record as a NumPy structured dtype, for reading whole files at once
+RECORD_DTYPE_v3 = [ ('spo2', 'u1'), ('heartrate', 'u1'), ('oximetry_invalid', '?'), ('motion', 'u1'), ('vibration', 'u1') ]
+
 class o2filereadbin:
     def __init__( self, fname ):
         self.ftype = None
@@ -38,6 +54,9 @@ class o2filereadbin:
 
         self.ftype = 'vld' + str(self.header['version'])
         #self.header['o2_score'] /= 10
+        # 32 bit values split into low and high halves
+        self.header['filesize'] |= self.header.pop( 'filesize2' ) << 16
+        self.header['duration'] |= self.header.pop( 'duration2' ) << 16
         self.header['rawsize'] = os.fstat( self.fp.fileno() ).st_size
         self.header['records'] = (self.header['rawsize'] - 40) / float(RECORD_SIZE_v3)
         self.header['resolution'] = self.header['duration'] / self.header['records']
@@ -47,6 +66,7 @@ class o2filereadbin:
 
         t = time.strptime( '{year:d}-{month:02d}-{day:02d},{hour:02d}:{minute:02d}:{second:02d}'.format( **self.header ), '%Y-%m-%d,%H:%M:%S' )
         self.header['time'] = datetime.datetime( *t[:6] )
+        self.start_time = self.header['time']
         self.header['tdelta'] = datetime.timedelta( seconds=self.header['resolution'] )
 
         #print( self.header )
@@ -63,7 +83,7 @@ class o2filereadbin:
         if( len(rec) != RECORD_SIZE_v3 ):
             return None
 
-        rec = namedtuple( 'ViatomRecord', 'spo2 heartrate oximetry_invalid motion vibration' )._make( struct.unpack( '<BB?BB', rec ) )._asdict()
+        rec = ViatomRecord._make( RECORD_v3.unpack( rec ) )._asdict()
 
         if( rec['spo2'] < 10 or rec['spo2'] > 100 ):
             rec['oximetry_invalid'] = True
@@ -80,22 +100,166 @@ class o2filereadbin:
             yield rec
             rec = self.read_record()
 
+    def to_arrays( self ):
+        """
+        Read every record in one go, returns a dict of NumPy columns: time
+        (datetime64[ms]), spo2, heartrate, oximetry_invalid, motion and
+        vibration.  Independent of, and doesn't move, the records() position.
+        """
+        if( np is None ):
+            raise ImportError( 'to_arrays needs numpy' )
+
+        count = int( self.header['records'] )
+        pos = self.fp.tell()
+        self.fp.seek( 40 )
+        recs = np.fromfile( self.fp, dtype=np.dtype( RECORD_DTYPE_v3 ), count=count )
+        self.fp.seek( pos )
+
+        return self._columns( recs, 0 )
+
+    def _columns( self, recs, first ):
+        # split structured records into columns, first is the index of recs[0]
+        cols = { name: recs[name] for name in recs.dtype.names }
+        cols['oximetry_invalid'] = cols['oximetry_invalid'] | (cols['spo2'] < 10) | (cols['spo2'] > 100)
+
+        step = np.timedelta64( int( self.header['resolution'] * 1000 ), 'ms' )
+        cols['time'] = np.datetime64( self.start_time, 'ms' ) + np.arange( first, first + len(recs) ) * step
+
+        return cols
+
     def close( self ):
         if( self.fp ):
             self.fp.close()
             self.fp = None
 
 
+class o2filemapbin( o2filereadbin ):
+    """
+    Random access to a vld3 file through mmap.  Records are fixed size at a
+    fixed resolution, so a record index or a time maps straight to an offset.
+
+    f[i] returns one record dict like read_record(), f[i:j] and
+    slice_by_time() return NumPy columns like to_arrays(), viewing the map
+    where they can.
+    """
+
+    def __init__( self, fname ):
+        super().__init__( fname )
+        self.count = int( self.header['records'] )
+        self.mm = mmap.mmap( self.fp.fileno(), 0, access=mmap.ACCESS_READ )
+
+    def __len__( self ):
+        return self.count
+
+    def __getitem__( self, idx ):
+        if( isinstance( idx, slice ) ):
+            (start, stop, stride) = idx.indices( self.count )
+            if( np is None ):
+                raise ImportError( 'slicing needs numpy' )
+
+            stop = max( start, stop )
+            recs = np.frombuffer( self.mm, dtype=np.dtype( RECORD_DTYPE_v3 ), count=stop - start, offset=40 + start * RECORD_SIZE_v3 )
+            cols = self._columns( recs, start )
+            if( stride != 1 ):
+                cols = { name: col[::stride] for name, col in cols.items() }
+            return cols
+
+        if( idx < 0 ):
+            idx += self.count
+        if( idx < 0 or idx >= self.count ):
+            raise IndexError( 'record index out of range' )
+
+        rec = ViatomRecord._make( RECORD_v3.unpack_from( self.mm, 40 + idx * RECORD_SIZE_v3 ) )._asdict()
+
+        if( rec['spo2'] < 10 or rec['spo2'] > 100 ):
+            rec['oximetry_invalid'] = True
+
+        rec['time'] = (self.start_time + idx * self.header['tdelta']).strftime( CSV_TIMEFMT )
+
+        return rec
+
+    def _when( self, when ):
+        # a time of day is taken as the first such time after the recording starts
+        if( isinstance( when, datetime.time ) ):
+            day = datetime.datetime.combine( self.start_time.date(), when )
+            if( day < self.start_time ):
+                day += datetime.timedelta( days=1 )
+            return day
+        return when
+
+    def index_of( self, when ):
+        """ Index of the first record at or after when, a datetime or time of day """
+        secs = (self._when( when ) - self.start_time).total_seconds()
+        idx = math.ceil( secs / self.header['resolution'] )
+        return min( max( idx, 0 ), self.count )
+
+    def slice_by_time( self, start, end ):
+        """
+        Columns for the records from start up to (not including) end.  With
+        times of day, 02:00 to 03:00 finds the early hours of the night and
+        23:30 to 00:30 spans midnight.
+        """
+        start = self._when( start )
+        if( isinstance( end, datetime.time ) ):
+            day = datetime.datetime.combine( start.date(), end )
+            end = day if day > start else day + datetime.timedelta( days=1 )
+
+        first = self.index_of( start )
+        return self[first:max( first, self.index_of( end ) )]
+
+    def close( self ):
+        if( getattr( self, 'mm', None ) ):
+            try:
+                self.mm.close()
+            except BufferError:
+                # columns handed out still point into the map, let them keep it
+                pass
+            self.mm = None
+        super().close()
+
+
+
+MONTHS = { m: i + 1 for i, m in enumerate( ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec') ) }
+EPOCH = datetime.date( 1970, 1, 1 )
+
+def csv_seconds( when, dates ):
+    """
+    Epoch seconds (of the naive local time) for a CSV_TIMEFMT timestamp.
+    dates caches the date part, which rarely changes, so only the time of
+    day is parsed for most rows.
+    """
+    # hh:mm:ssAM Mon dd, yyyy
+    day = dates.get( when[11:] )
+    if( day is None or when[2] != ':' or when[5] != ':' ):
+        try:
+            d = datetime.date( int( when[-4:] ), MONTHS[when[11:14]], int( when[15:17] ) )
+            if( when[17:19] != ', ' ):
+                raise ValueError( when )
+        except (KeyError, ValueError, IndexError):
+            d = datetime.datetime.strptime( when, CSV_TIMEFMT )
+            return (d.date() - EPOCH).days * 86400 + d.hour * 3600 + d.minute * 60 + d.second
+        day = dates[when[11:]] = (d - EPOCH).days * 86400
+
+    hour = int( when[0:2] ) % 12
+    if( when[8] in 'Pp' ):
+        hour += 12
+    return day + hour * 3600 + int( when[3:5] ) * 60 + int( when[6:8] )
 
 class o2filereadcsv:
+    """
+    Streams CSV files in the CSV_TITLES / CSV_TIMEFMT layout that
+    o2filewritecsv and the vendor apps produce.  records() yields the same
+    dicts as o2filereadbin.records(); chunks() yields NumPy columns per N
+    rows without building a datetime per row.
+    """
+
     def __init__( self, fname ):
         self.ftype = 'csv'
         self.fname = fname
-
-        raise NotImplementedError()
+        self.dates = {}  # date part of a timestamp -> epoch seconds of that midnight
 
         try:
-            self.fp = open( fname, 'rb' )
+            self.fp = open( fname, 'r', newline='' )
         except:
             self.fp = None
             raise
@@ -109,11 +273,103 @@ class o2filereadcsv:
         self.close()
 
     def _parse_header(self):
-        raise NotImplementedError()
-        raw = self.fp.read(40)
+        self.reader = csv.reader( self.fp )
+        titles = { v.lower(): k for k, v in CSV_TITLES.items() }
+
+        try:
+            row = next( self.reader )
+        except StopIteration:
+            raise EOFError( 'Failed to read CSV file header' )
+
+        self.columns = { titles[t.strip().lower()]: i for i, t in enumerate( row ) if t.strip().lower() in titles }
+
+        for need in ('time', 'spo2', 'heartrate'):
+            if( need not in self.columns ):
+                raise ImportError( 'CSV file has no %s column' % CSV_TITLES[need] )
+
+        # the first two rows give the start time and resolution
+        self.head = []
+        for row in self.reader:
+            if( row ):
+                self.head.append( row )
+                if( len(self.head) == 2 ):
+                    break
+
+        self.header = { 'time': None, 'resolution': None }
+        if( self.head ):
+            t = [ self._seconds( r[self.columns['time']] ) for r in self.head ]
+            self.header['time'] = datetime.datetime( 1970, 1, 1 ) + datetime.timedelta( seconds=t[0] )
+            if( len(t) > 1 ):
+                self.header['resolution'] = float( t[1] - t[0] )
+
+    def _seconds( self, when ):
+        return csv_seconds( when, self.dates )
+
+    def _rows( self ):
+        yield from self.head
+        self.head = []
+        for row in self.reader:
+            if( row ):
+                yield row
+
+    def _values( self, row ):
+        """ Returns (spo2, heartrate, invalid, motion, vibration) for a row """
+        cols = self.columns
+        try:
+            spo2 = int( row[cols['spo2']] )
+            invalid = spo2 < 10 or spo2 > 100
+        except ValueError:
+            # '--' or blank when there was no reading
+            spo2 = 0xFF
+            invalid = True
+
+        try:
+            hr = int( row[cols['heartrate']] )
+        except ValueError:
+            hr = 0xFF
+
+        motion = int( row[cols['motion']] or 0 ) if 'motion' in cols else 0
+        vibration = int( row[cols['vibration']] or 0 ) if 'vibration' in cols else 0
+
+        return (spo2, hr, invalid, motion, vibration)
 
     def records( self ):
-        raise NotImplementedError()
+        col = self.columns['time']
+        for row in self._rows():
+            rec = ViatomRecord._make( self._values( row ) )._asdict()
+            rec['time'] = row[col]
+            yield rec
+
+    def chunks( self, size=4096 ):
+        """ Yields dicts of NumPy columns (as to_arrays()) for each size rows """
+        if( np is None ):
+            raise ImportError( 'chunks needs numpy' )
+
+        col = self.columns['time']
+        times = []
+        values = []
+        for row in self._rows():
+            times.append( self._seconds( row[col] ) )
+            values.append( self._values( row ) )
+            if( len(times) >= size ):
+                yield self._columns( times, values )
+                times = []
+                values = []
+
+        if( times ):
+            yield self._columns( times, values )
+
+    def to_arrays( self ):
+        parts = list( self.chunks() )
+        if( not parts ):
+            return self._columns( [], [] )
+        return { name: np.concatenate( [ p[name] for p in parts ] ) for name in parts[0] }
+
+    def _columns( self, times, values ):
+        recs = np.array( values, dtype=np.dtype( RECORD_DTYPE_v3 ) ) if values else np.zeros( 0, dtype=np.dtype( RECORD_DTYPE_v3 ) )
+        cols = { name: recs[name] for name in recs.dtype.names }
+        cols['time'] = np.array( times, dtype='datetime64[s]' ).astype( 'datetime64[ms]' )
+        return cols
 
     def close( self ):
         if( self.fp ):
@@ -123,18 +379,23 @@ class o2filereadcsv:
 
 def o2fileread( fname ):
     fp = open( fname, 'rb' )
-    ver = fp.read( 2 )
+    head = fp.read( 256 )
     fp.close()
 
-    if( ver == b'\x03\x00' ):
+    if( head[:2] == b'\x03\x00' ):
         #print('bin')
         return o2filereadbin( fname )
 
-    if( fname[-4:] == '.csv' ):
+    if( head[:4] == b'PK\x03\x04' ):
+        # zip archive, .npz
+        return o2filereadnpz( fname )
+
+    # a .csv, or anything whose first line has our column titles
+    first = head.split( b'\n' )[0].decode( 'utf-8', 'replace' ).lower()
+    if( fname[-4:].lower() == '.csv' or all( CSV_TITLES[t].lower() in first for t in ('time', 'spo2', 'heartrate') ) ):
         #print('csv')
         return o2filereadcsv( fname )
 
-    # FIXME try harder to detect CSV?
     return None
 
 
@@ -158,27 +419,284 @@ class o2filewritecsv:
             self.fp = None
 
 class o2filewritebin:
+    """
+    Writes vld3 files.  Records come from writerow() dicts (as records()
+    yields them) or whole columns through write_arrays(), are buffered and
+    packed in bulk, and the 40 byte header is filled in on close() once the
+    duration and SpO2 statistics are known.
+
+    The oximetry_invalid flag is written as given; SpO2 outside 10-100 is
+    only left out of the statistics.  Note records() and to_arrays() set
+    the flag for such values (the ring writes 0xFF with it clear), so a
+    file read and written back can differ in that byte alone.
+    """
+
+    FLUSH_RECORDS = 8192
+
     def __init__( self, fname ):
         self.ftype = 'vld3'
         self.fname = fname
 
-        raise NotImplementedError()
+        self.fp = open( fname, 'wb' )
+        self.fp.write( bytes(40) )
 
-        self.fp = open( fname, 'w' )
+        self.pending = []           # flattened record bytes not yet written
+        self.spo2 = bytearray()     # SpO2 of every record, 0 where invalid
+        self.start = None
+        self.resolution = None
+        self.last = None
+
+    def _note_time( self, when ):
+        # only the first two timestamps are needed, for the start and resolution
+        if( self.resolution is not None or when is None or when == '' ):
+            return
+
+        if( isinstance( when, str ) ):
+            when = datetime.datetime.strptime( when, CSV_TIMEFMT )
+
+        if( self.start is None ):
+            self.start = when
+        else:
+            self.resolution = (when - self.start).total_seconds()
 
     def writerow( self, data ):
-        self.csvout.writerow( data )
+        if( len(self.spo2) < 2 ):
+            self._note_time( data.get( 'time' ) )
+
+        spo2 = int( data['spo2'] )
+        flag = bool( data.get( 'oximetry_invalid' ) )
+        self.pending.extend( ( spo2, int( data['heartrate'] ), flag, int( data.get( 'motion' ) or 0 ), int( data.get( 'vibration' ) or 0 ) ) )
+        self.spo2.append( 0 if (flag or spo2 < 10 or spo2 > 100) else spo2 )
+
+        if( len(self.pending) >= self.FLUSH_RECORDS * RECORD_SIZE_v3 ):
+            self.flush()
+
+    def write_arrays( self, cols ):
+        """ Write NumPy columns, as returned by o2filereadbin.to_arrays() """
+        if( np is None ):
+            raise ImportError( 'write_arrays needs numpy' )
+
+        self.flush()
+
+        spo2 = np.asarray( cols['spo2'] ).astype( 'u1' )
+        flag = np.asarray( cols.get( 'oximetry_invalid', np.zeros( len(spo2), bool ) ) ).astype( bool )
+        invalid = flag | (spo2 < 10) | (spo2 > 100)
+
+        recs = np.zeros( len(spo2), dtype=np.dtype( RECORD_DTYPE_v3 ) )
+        recs['spo2'] = spo2
+        recs['heartrate'] = cols['heartrate']
+        recs['oximetry_invalid'] = flag
+        for name in ('motion', 'vibration'):
+            if( name in cols ):
+                recs[name] = cols[name]
+
+        if( 'time' in cols and len(spo2) > 0 and len(self.spo2) < 2 ):
+            times = np.asarray( cols['time'] ).astype( 'datetime64[ms]' )
+            for t in times[:2 - len(self.spo2)]:
+                self._note_time( t.astype( datetime.datetime ) )
+
+        self.fp.write( recs.tobytes() )
+        self.spo2 += np.where( invalid, 0, spo2 ).astype( 'u1' ).tobytes()
+
+    def flush( self ):
+        if( self.pending ):
+            self.fp.write( bytes( self.pending ) )
+            self.pending = []
+
+    def _header( self ):
+        count = len(self.spo2)
+        resolution = int( self.resolution or 4 )
+        start = self.start or datetime.datetime.now()
+        valid = [ v for v in self.spo2 if v ]
+
+        duration = count * resolution
+        filesize = 40 + count * RECORD_SIZE_v3
+        under90 = [ v < 90 for v in valid ]
+        events90 = sum( 1 for i, u in enumerate( under90 ) if u and (i == 0 or not under90[i-1]) )
+
+        # the 32 bit size and duration are split into low and high halves,
+        #  counts saturate at their field size
+        return struct.pack( '<HHBBBBBHHHHBBBBBHBB', 3, start.year, start.month, start.day, start.hour, start.minute, start.second,
+            filesize & 0xFFFF, filesize >> 16, duration & 0xFFFF, duration >> 16,
+            round( sum(valid) / len(valid) ) if valid else 0, min(valid) if valid else 0,
+            min( desat_events( valid, 3, resolution ), 0xFF ), min( desat_events( valid, 4, resolution ), 0xFF ), 0,
+            min( sum( under90 ) * resolution, 0xFFFF ), min( events90, 0xFF ), 0 ).ljust( 40, b'\0' )
 
     def close( self ):
         if( self.fp ):
+            self.flush()
+            self.fp.seek( 0 )
+            self.fp.write( self._header() )
+            self.fp.close()
+            self.fp = None
+
+
+class o2filewritenpz:
+    """
+    Writes a night as NumPy columns in an .npz archive: time
+    (datetime64[ms]), spo2, heartrate, oximetry_invalid, motion and
+    vibration, plus the source file's parsed header as JSON under 'header'.
+    Loading it back is a few array reads instead of parsing every row.
+    compress selects np.savez_compressed.
+    """
+
+    def __init__( self, fname, header=None, compress=False ):
+        if( np is None ):
+            raise ImportError( 'o2filewritenpz needs numpy' )
+
+        self.ftype = 'npz'
+        self.fname = fname
+        self.compress = compress
+        # copied now, o2filereadbin moves header['time'] along as it reads
+        self.header = dict( header or {} )
+
+        self.fp = open( fname, 'wb' )
+
+        self.rows = { name: array( 'B' ) for name in NPZ_FIELDS }
+        self.times = array( 'q' )   # ms since the epoch, naive local time
+        self.dates = {}
+        self.chunks = []            # columns from write_arrays() and flushed rows, in order
+
+    def writerow( self, data ):
+        spo2 = int( data['spo2'] )
+        rows = self.rows
+        rows['spo2'].append( spo2 )
+        rows['heartrate'].append( int( data['heartrate'] ) )
+        rows['oximetry_invalid'].append( bool( data.get( 'oximetry_invalid' ) ) or spo2 < 10 or spo2 > 100 )
+        rows['motion'].append( int( data.get( 'motion' ) or 0 ) )
+        rows['vibration'].append( int( data.get( 'vibration' ) or 0 ) )
+
+        when = data.get( 'time' )
+        if( isinstance( when, str ) ):
+            self.times.append( csv_seconds( when, self.dates ) * 1000 )
+        elif( isinstance( when, datetime.datetime ) ):
+            self.times.append( ((when.date() - EPOCH).days * 86400 + when.hour * 3600 + when.minute * 60 + when.second) * 1000 + when.microsecond // 1000 )
+        else:
+            self.times.append( np.iinfo( 'int64' ).min ) # NaT
+
+    def write_arrays( self, cols ):
+        """ Write NumPy columns, as returned by to_arrays() """
+        self.flush()
+
+        spo2 = np.asarray( cols['spo2'] ).astype( 'u1' )
+        chunk = { 'spo2': spo2, 'heartrate': np.asarray( cols['heartrate'] ).astype( 'u1' ) }
+        chunk['oximetry_invalid'] = np.asarray( cols.get( 'oximetry_invalid', np.zeros( len(spo2), bool ) ) ).astype( bool ) | (spo2 < 10) | (spo2 > 100)
+        for name in ('motion', 'vibration'):
+            chunk[name] = np.asarray( cols[name] ).astype( 'u1' ) if name in cols else np.zeros( len(spo2), 'u1' )
+        chunk['time'] = np.asarray( cols['time'] ).astype( 'datetime64[ms]' ) if 'time' in cols else np.full( len(spo2), np.datetime64( 'NaT', 'ms' ) )
+
+        self.chunks.append( chunk )
+
+    def flush( self ):
+        """ Move buffered rows into a chunk of columns """
+        if( not self.times ):
+            return
+
+        chunk = { name: np.frombuffer( col, 'u1' ).copy() for name, col in self.rows.items() }
+        chunk['oximetry_invalid'] = chunk['oximetry_invalid'].astype( bool )
+        chunk['time'] = np.frombuffer( self.times, 'i8' ).astype( 'datetime64[ms]' )
+        self.chunks.append( chunk )
+
+        self.rows = { name: array( 'B' ) for name in NPZ_FIELDS }
+        self.times = array( 'q' )
+
+    def close( self ):
+        if( not self.fp ):
+            return
+
+        self.flush()
+
+        cols = {}
+        for name, dtype in (('time', 'datetime64[ms]'),) + tuple( (n, 'bool' if n == 'oximetry_invalid' else 'u1') for n in NPZ_FIELDS ):
+            parts = [ c[name] for c in self.chunks ]
+            cols[name] = np.concatenate( parts ) if parts else np.zeros( 0, dtype )
+
+        header = json.dumps( self.header, default=str )
+        save = np.savez_compressed if self.compress else np.savez
+        # given a file object, not a name, so savez doesn't add its own .npz suffix
+        save( self.fp, header=np.array( header ), **cols )
+
+        self.fp.close()
+        self.fp = None
+        self.chunks = []
+
+
+class o2filereadnpz:
+    """
+    Reads .npz files from o2filewritenpz.  to_arrays() returns the stored
+    columns as they are; records() yields the usual record dicts.
+    """
+
+    def __init__( self, fname ):
+        if( np is None ):
+            raise ImportError( 'o2filereadnpz needs numpy' )
+
+        self.ftype = 'npz'
+        self.fname = fname
+        self.fp = np.load( fname, allow_pickle=False )
+
+        if( 'header' not in self.fp.files or 'spo2' not in self.fp.files ):
+            self.close()
+            raise ImportError( 'Not an o2r .npz file' )
+
+        self.header = json.loads( str( self.fp['header'] ) )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, exc_traceback ):
+        self.close()
+
+    def to_arrays( self ):
+        return { name: self.fp[name] for name in ('time',) + NPZ_FIELDS }
+
+    def records( self ):
+        cols = self.to_arrays()
+        times = cols.pop( 'time' ).astype( datetime.datetime )
+        for i, rec in enumerate( zip( *( cols[name].tolist() for name in NPZ_FIELDS ) ) ):
+            rec = ViatomRecord._make( rec )._asdict()
+            rec['time'] = times[i].strftime( CSV_TIMEFMT ) if times[i] is not None else ''
+            yield rec
+
+    def close( self ):
+        if( self.fp is not None ):
             self.fp.close()
             self.fp = None
 
 
-def o2filewrite( fname, ftype ):
+def desat_events( spo2, drop, resolution, window=120 ):
+    """
+    Count desaturations, falls of at least drop points below the highest
+    SpO2 of the preceding window seconds.  A new event can only start once
+    SpO2 has come back to within a point of that baseline.
+    """
+    events = 0
+    recent = collections.deque( maxlen=max( 1, int( window // resolution ) ) )
+    baseline = None
+    in_event = False
+
+    for v in spo2:
+        if( not in_event ):
+            recent.append( v )
+            baseline = max( recent )
+            if( v <= baseline - drop ):
+                events += 1
+                in_event = True
+        elif( v >= baseline - 1 ):
+            in_event = False
+            recent.clear()
+            recent.append( v )
+
+    return events
+
+
+def o2filewrite( fname, ftype, header=None, compress=False ):
     if( ftype == 'csv' ):
         return o2filewritecsv( fname )
 
+    if( ftype == 'npz' ):
+        return o2filewritenpz( fname, header=header, compress=compress )
+
     return o2filewritebin( fname )
 
 
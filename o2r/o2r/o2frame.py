@@ -0,0 +1,138 @@
+import struct
+
+HEADER = struct.Struct( '<BBBHH' )
+HEADER_LEN = HEADER.size
+
+class o2framer:
+    """
+    Reassembles ring replies out of BLE notifications.
+
+    A reply is a 7 byte header (0x55, status, ~status, block, length), the
+    payload and a CRC byte.  Once the header is in, the frame length is
+    known, so a buffer of that size is allocated and each notification is
+    copied straight into place.  Completed frames are handed out as
+    memoryviews of their buffer; each frame has its own, so slices of it
+    stay valid.
+
+    A notification may finish one frame and start the next.  A bad header
+    drops the rest of its notification; frames completed before it are
+    still returned, and the error is counted in errors and kept in error
+    for the caller to pick up.
+    """
+
+    def __init__( self ):
+        self.hdr = bytearray()
+        self.buf = None     # memoryview of the current frame's buffer
+        self.pos = 0        # bytes of it filled in
+        self.end = 0        # its length, 0 between frames
+        self.block = None   # block number of the current frame, once its header is in
+        self.errors = 0
+        self.error = None
+
+    def reset( self ):
+        """ Discard any partially received frame """
+        self.hdr.clear()
+        self.buf = None
+        self.pos = 0
+        self.end = 0
+        self.block = None
+
+    def pending( self ):
+        return self.end > 0 or len(self.hdr) > 0
+
+    def feed( self, data ):
+        """ Returns a sequence of the frames completed by this notification """
+        pos = self.pos
+        end = pos + len(data)
+        if( end < self.end ):
+            # the common case, a whole notification in the middle of a frame
+            self.buf[pos:end] = data
+            self.pos = end
+            return ()
+
+        if( end == self.end and end ):
+            # the last notification of a frame, and nothing after it
+            frame = self.buf
+            frame[pos:end] = data
+            self.buf = None
+            self.pos = 0
+            self.end = 0
+            self.block = None
+            return (frame,)
+
+        if( self.end == 0 and end >= HEADER_LEN and not self.hdr ):
+            # the first notification of a frame
+            try:
+                self._start( data, 0 )
+            except (TypeError, KeyError) as e:
+                self.errors += 1
+                self.error = e
+                return ()
+
+            if( end < self.end ):
+                self.buf[:end] = data
+                self.pos = end
+                return ()
+
+        return self._feed( data )
+
+    def _feed( self, data ):
+        # a notification finishing one frame and starting another, or a
+        #  split header
+        done = []
+        data = memoryview( data )
+        n = len(data)
+        src = 0
+
+        while src < n:
+            if( self.end == 0 ):
+                try:
+                    if( not self.hdr and n - src >= HEADER_LEN ):
+                        # header is all here, it is copied along with the payload
+                        self._start( data, src )
+                    else:
+                        k = min( HEADER_LEN - len(self.hdr), n - src )
+                        self.hdr += data[src:src+k]
+                        src += k
+
+                        if( len(self.hdr) < HEADER_LEN ):
+                            break
+
+                        self._start( self.hdr, 0 )
+                        self.buf[:HEADER_LEN] = self.hdr
+                        self.pos = HEADER_LEN
+                        self.hdr.clear()
+                except (TypeError, KeyError) as e:
+                    # can't tell where the next frame starts, drop the rest
+                    self.reset()
+                    self.errors += 1
+                    self.error = e
+                    break
+
+            pos = self.pos
+            k = min( self.end - pos, n - src )
+            self.buf[pos:pos+k] = data[src:src+k]
+            self.pos = pos + k
+            src += k
+
+            if( self.pos == self.end ):
+                done.append( self.buf )
+                self.buf = None
+                self.pos = 0
+                self.end = 0
+                self.block = None
+
+        return done
+
+    def _start( self, buf, pos ):
+        (src, cmd, ncmd, block, length) = HEADER.unpack_from( buf, pos )
+
+        if( src != 0x55 ):
+            raise TypeError("Packet not from ring")
+
+        if( cmd != (ncmd ^ 0xFF) ):
+            raise KeyError("Command Check Failed")
+
+        self.end = HEADER_LEN + length + 1
+        self.buf = memoryview( bytearray( self.end ) )
+        self.block = block
@@ -0,0 +1,55 @@
+import json
+import os
+
+# where o2ring.py keeps it unless told otherwise
+GATT_CACHE_FILE = os.path.join( '~', '.cache', 'o2r', 'gatt.json' )
+
+class o2gattcache:
+    """
+    Per-MAC cache of the ring's GATT layout, kept as JSON on disk.
+
+    Each entry records the service UUID and the handle and UUID of the
+    characteristic notifications are enabled on ('read') and of the one
+    commands are written to ('write').  O2BTDevice looks the handles up
+    after connecting instead of walking every service, and drops the entry
+    if they no longer match so the next connect does a full discovery.
+    A missing or unreadable file is treated as an empty cache.
+    """
+
+    def __init__( self, fname=GATT_CACHE_FILE ):
+        self.fname = os.path.expanduser( fname )
+        self.entries = {}
+
+        try:
+            with open( self.fname ) as f:
+                self.entries = json.load( f )
+        except (OSError, ValueError):
+            pass
+
+        if( not isinstance( self.entries, dict ) ):
+            self.entries = {}
+
+    def get( self, mac ):
+        """ The entry for mac, or None """
+        return self.entries.get( mac )
+
+    def put( self, mac, service, read, write ):
+        """ Record the service UUID and the read/write characteristics (anything with .handle and .uuid) for mac """
+        entry = { 'service': service, 'read': [read.handle, read.uuid], 'write': [write.handle, write.uuid] }
+        if( self.entries.get( mac ) != entry ):
+            self.entries[mac] = entry
+            self._save()
+
+    def drop( self, mac ):
+        if( self.entries.pop( mac, None ) is not None ):
+            self._save()
+
+    def _save( self ):
+        try:
+            os.makedirs( os.path.dirname( self.fname ) or '.', exist_ok=True )
+            with open( self.fname + '.tmp', 'w' ) as f:
+                json.dump( self.entries, f, indent=1 )
+            os.replace( self.fname + '.tmp', self.fname )
+        except OSError as e:
+            # only costs a slower connect next time
+            print( 'Failed to save GATT cache %s: %r' % (self.fname, e) )
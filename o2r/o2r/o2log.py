@@ -0,0 +1,91 @@
+import asyncio
+import concurrent.futures
+
+class o2logwriter:
+    """
+    Buffered append-only logs for realtime data.
+
+    write() only appends to an in-memory batch, so it is safe to call from
+    the notification path.  Batches are handed to a single disk thread once a
+    file has flush_bytes buffered or every flush_interval seconds, whichever
+    comes first.  Each file is opened once and kept open until close().
+    One worker keeps the writes to each file in order.
+    """
+
+    def __init__( self, flush_interval=1.0, flush_bytes=65536 ):
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.executor = concurrent.futures.ThreadPoolExecutor( max_workers=1, thread_name_prefix='o2log' )
+        self.pending = {}  # fname -> list of str or bytes chunks
+        self.pending_bytes = {}
+        self.files = {}    # fname -> open file, only touched on the disk thread
+        self.last_job = None
+        self.task = None
+
+    def start( self ):
+        if self.task is None:
+            self.task = asyncio.ensure_future( self._run() )
+
+    def write( self, fname, data ):
+        """ Queue data (str or bytes, but one kind per file) to be appended to fname """
+        if fname not in self.pending:
+            self.pending[fname] = []
+            self.pending_bytes[fname] = 0
+
+        self.pending[fname].append( data )
+        self.pending_bytes[fname] += len( data )
+
+        if self.pending_bytes[fname] >= self.flush_bytes:
+            self.flush()
+
+    def flush( self ):
+        """ Hand everything buffered so far to the disk thread """
+        batch = { f: c for f, c in self.pending.items() if c }
+        if not batch:
+            return self.last_job
+
+        for f in batch:
+            self.pending[f] = []
+            self.pending_bytes[f] = 0
+
+        job = asyncio.get_event_loop().run_in_executor( self.executor, self._write_out, batch )
+        job.add_done_callback( self._done )
+        self.last_job = job
+        return job
+
+    async def close( self ):
+        """ Write out anything still buffered, close the files and stop the disk thread """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        self.flush()
+        await asyncio.get_event_loop().run_in_executor( self.executor, self._close_files )
+        self.executor.shutdown( wait=True )
+
+    async def _run( self ):
+        try:
+            while True:
+                await asyncio.sleep( self.flush_interval )
+                self.flush()
+        except asyncio.CancelledError:
+            pass
+
+    def _write_out( self, batch ):
+        for fname, chunks in batch.items():
+            fp = self.files.get( fname )
+            if fp is None:
+                binary = isinstance( chunks[0], (bytes, bytearray, memoryview) )
+                fp = self.files[fname] = open( fname, 'ab' if binary else 'a' )
+
+            fp.write( (b'' if 'b' in fp.mode else '').join( chunks ) )
+            fp.flush()
+
+    def _close_files( self ):
+        for fp in self.files.values():
+            fp.close()
+        self.files = {}
+
+    def _done( self, job ):
+        if not job.cancelled() and job.exception() is not None:
+            print( 'Log write failed:', repr(job.exception()) )
@@ -2,15 +2,26 @@ import struct
 #import binascii
 
 from .defines import *
+from .o2crc import crc8
+from .o2frame import o2framer
+
+# (cmd, long) -> the packet with no payload and block 0, built on first use
+_packets = {}
 
 class o2pkt:
     
-    def __init__(self, cmd, block=0, data=None, long=False):
+    def __init__(self, cmd, block=0, data=None, long=False, priority=None):
         self.cmd = cmd
+        self.priority = priority if priority is not None else CMD_PRIORITY.get( cmd, PRIO_CONFIG )
         self.block = block
         self.extra = data
         self.long = long or False
-        self.recv_buf = ""
+        self.tries = 0      # times sent, see O2BTDevice
+        self.cancelled = False  # no longer wanted, see O2BTDevice.cancel()
+        self.timer = None
+        self.framer = None
+        self.more = ()      # frames after this packet's reply, see recv()
+        self.recv_buf = b""
         self.recv_want = None
         self.recv_cmd = None
         self.recv_block = 0
@@ -18,6 +29,16 @@ class o2pkt:
         self.recv_data = b""
 
     def packetify( self ):
+        if not self.extra and not self.block:
+            # the same bytes every time
+            out = _packets.get( (self.cmd, self.long) )
+            if out is None:
+                out = _packets[(self.cmd, self.long)] = self._pack()
+            return out
+
+        return self._pack()
+
+    def _pack( self ):
         if self.long: # A Long packet is used in the realtime data commands
             out = struct.pack(
                 "<5BHB", 
@@ -40,56 +61,44 @@ class o2pkt:
         return out
 
     def recv( self, data ):
-        if self.recv_want is None:
-            if( len(data) < 8 ):
-                raise EOFError("Receive didn't return enough data")
-
-            (src, self.recv_cmd, ncmd, self.recv_block, self.recv_want) = struct.unpack( '<BBBHH', data[:7] )
-
-            if( src != 0x55 ):
-                raise TypeError("Packet not from ring")
-
-            if( self.recv_cmd != (ncmd ^ 0xFF) ):
-                raise KeyError("Command Check Failed")
-
-            self.recv_buf = data
-            self.recv_want += 8
-        else:
-            self.recv_buf += data
-
-        if( len(self.recv_buf) < self.recv_want ):
-            #print('want', self.recv_want, 'have', len(self.recv_buf))
+        """
+        Feed one notification, returns True once the reply is complete.
+        Used when the packet owns the link; O2BTDevice shares one o2framer
+        per device and hands completed frames to recv_frame() instead.
+
+        If the notification also holds later replies, the complete ones are
+        left in self.more for the caller to pass to the next packets'
+        recv_frame(), and self.framer, which has any partial one, can be
+        handed on to the next packet.
+        """
+        if self.framer is None:
+            self.framer = o2framer()
+
+        frames = self.framer.feed( data )
+
+        if( self.framer.error is not None ):
+            (e, self.framer.error) = (self.framer.error, None)
+            raise e
+
+        if( not frames ):
             return False
 
-        if( len(self.recv_buf) != self.recv_want ):
-            raise BufferError("Got more data than expected")
+        self.more = frames[1:]
+        return self.recv_frame( frames[0] )
 
-        if( self.chksum(self.recv_buf[:-1]) != self.recv_buf[-1] ):
-            raise ValueError("Checksum Failed! want %02X got %02X" % (self.recv_buf[-1], self.recv_crc))
+    def recv_frame( self, frame ):
+        """ Take a complete frame (a memoryview from o2framer) as this packet's reply """
+        (self.recv_cmd, self.recv_block) = struct.unpack_from( '<BxH', frame, 1 )
+        self.recv_want = len(frame)
+        self.recv_buf = frame
 
-        self.recv_data = self.recv_buf[7:-1]
-        return True # self.recv_buf[:-1]
-
-    # Standard CRC-8-CCITT checksum with 0x07 polynomial and 0x00 seed
-    #  below function uses a hybrid method instead of a lookup table or bit shifting
-    def _crc_byte( self, b ):
-        chk = self.recv_crc ^ b
-        self.recv_crc = 0
+        if( self.chksum(frame[:-1]) != frame[-1] ):
+            raise ValueError("Checksum Failed! want %02X got %02X" % (frame[-1], self.recv_crc))
 
-        # XOR values calculated for 0x01 0x02 0x04 0x08 0x10 0x20 0x40 0x80
-        if chk & 0x01: self.recv_crc = 0x07
-        if chk & 0x02: self.recv_crc ^= 0x0e
-        if chk & 0x04: self.recv_crc ^= 0x1c
-        if chk & 0x08: self.recv_crc ^= 0x38
-        if chk & 0x10: self.recv_crc ^= 0x70
-        if chk & 0x20: self.recv_crc ^= 0xe0
-        if chk & 0x40: self.recv_crc ^= 0xc7
-        if chk & 0x80: self.recv_crc ^= 0x89
+        self.recv_data = frame[7:-1]
+        return True
 
+    # Standard CRC-8-CCITT checksum with 0x07 polynomial and 0x00 seed, see o2crc
     def chksum( self, data ):
-        self.recv_crc = 0
-
-        for i in data:
-            self._crc_byte( i )
-
+        self.recv_crc = crc8( data )
         return self.recv_crc
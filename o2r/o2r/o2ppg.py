@@ -0,0 +1,243 @@
+import mmap
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Binary realtime PPG capture (.rtb)
+#
+# 64 byte file header:
+#   8s  magic 'O2RTPPG\0'
+#   H   format version
+#   H   sample rate (Hz)
+#   H   ppg_len, PPG sample slots per record
+#   H   record size
+#   q   wall clock at start (ns since the epoch)
+#   q   monotonic clock at start (ns), pairs with the above to place records in time
+#   32s device name, utf-8, NUL padded
+#
+# then fixed size records:
+#   q   monotonic arrival time (ns), see o2ppgwriter for records split from one packet
+#   4B  spo2, heart rate, battery, motion
+#   H   number of valid PPG samples
+#   ppg_len bytes of raw PPG samples, zero padded
+
+PPG_MAGIC = b'O2RTPPG\0'
+PPG_VERSION = 1
+PPG_HEADER = struct.Struct( '<8sHHHHqq32s' )
+PPG_RECORD = struct.Struct( '<q4BH' )
+
+# offsets into a CMD_RT_DATA payload
+RT_SPO2, RT_HR, RT_BATTERY, RT_MOTION, RT_PPG = 0, 1, 3, 5, 12
+
+class o2ppgwriter:
+    """
+    Writes CMD_RT_DATA payloads as .rtb records.
+
+    The PPG slot size is ppg_len, by default one second of samples (what a
+    reply to a once a second request carries).  A packet with more samples
+    than that, as a late reply in --stream mode can have, is split over as
+    many records as it needs, nothing is cut.  All but the last of those get
+    the arrival time backdated by the samples that follow them, so each
+    record still ends when its last sample was due, as o2ppgstream expects.
+    Split packets are counted in self.split.  If log (an o2logwriter) is
+    given the bytes are handed to it, otherwise they are written directly.
+    """
+
+    def __init__( self, fname, name, sample_rate=125, ppg_len=None, log=None ):
+        self.fname = fname
+        self.name = name
+        self.sample_rate = sample_rate
+        self.ppg_len = ppg_len or sample_rate
+        self.log = log
+        self.record = None
+        self.records = 0
+        self.split = 0
+
+        # start a fresh file, anything after this is appended
+        self.fp = open( fname, 'wb' )
+        if( log is not None ):
+            self.fp.close()
+            self.fp = None
+
+    def _header( self ):
+        self.record = struct.Struct( PPG_RECORD.format + '%ds' % self.ppg_len )
+        return PPG_HEADER.pack( PPG_MAGIC, PPG_VERSION, self.sample_rate, self.ppg_len, self.record.size,
+            time.time_ns(), time.monotonic_ns(), self.name.encode( 'utf-8' )[:32] )
+
+    def add( self, mono_ns, payload ):
+        """ Add one CMD_RT_DATA payload received at monotonic time mono_ns, returns the number of records written """
+        ppg = bytes( payload[RT_PPG:] )
+        out = b''
+
+        if( self.record is None ):
+            out = self._header()
+
+        n = max( 1, -(-len(ppg) // self.ppg_len) )
+        if( n > 1 ):
+            self.split += 1
+
+        for i in range( n ):
+            chunk = ppg[i*self.ppg_len:(i+1)*self.ppg_len]
+            after = len(ppg) - (i+1) * self.ppg_len
+            t = mono_ns - after * 1000000000 // self.sample_rate if after > 0 else mono_ns
+            # struct pads the 's' field with zeros
+            out += self.record.pack( t, payload[RT_SPO2], payload[RT_HR], payload[RT_BATTERY], payload[RT_MOTION], len(chunk), chunk )
+
+        self.records += n
+
+        if( self.log is not None ):
+            self.log.write( self.fname, out )
+        else:
+            self.fp.write( out )
+
+        return n
+
+    def close( self ):
+        if( self.fp ):
+            self.fp.close()
+            self.fp = None
+
+
+class o2ppgstream:
+    """
+    Stitches CMD_RT_DATA packets into one continuous sample timeline.
+
+    Each packet carries the samples the ring buffered since the last
+    request, and they end about when the packet arrives.  add() gives the
+    timeline index of a packet's first sample.  If the samples fall more
+    than max_lag seconds behind the host clock, the ring's buffer
+    overflowed between requests.  The missing samples are then counted in
+    dropped and skipped over in the timeline.
+    """
+
+    def __init__( self, sample_rate=125, max_lag=0.5 ):
+        self.sample_rate = sample_rate
+        self.max_lag = max_lag
+        self.start_ns = None
+        self.samples = 0
+        self.dropped = 0
+        self.gaps = 0
+
+    def add( self, mono_ns, count ):
+        """ Add a packet of count samples that arrived at mono_ns, returns (first sample index, samples dropped before it) """
+        if( self.start_ns is None ):
+            self.start_ns = mono_ns - count * 1000000000 // self.sample_rate
+
+        expected = (mono_ns - self.start_ns) * self.sample_rate / 1e9
+        lag = expected - (self.samples + count)
+        gap = 0
+
+        if( lag > self.max_lag * self.sample_rate ):
+            gap = round( lag )
+            self.dropped += gap
+            self.gaps += 1
+            self.samples += gap
+        elif( lag < 0 ):
+            # ahead of the host clock (latency or clock drift), move the anchor
+            self.start_ns -= int( -lag * 1e9 / self.sample_rate )
+
+        first = self.samples
+        self.samples += count
+        return (first, gap)
+
+
+class o2ppgreader:
+    """
+    Memory-maps a .rtb file.  records is a NumPy structured array viewing the
+    file directly (fields time, spo2, hr, battery, motion, count, ppg), so
+    nothing is parsed or copied until it is used.
+    """
+
+    def __init__( self, fname ):
+        if( np is None ):
+            raise ImportError( 'o2ppgreader needs numpy' )
+
+        self.fname = fname
+        self.fp = open( fname, 'rb' )
+        self.mm = None
+
+        try:
+            self.mm = mmap.mmap( self.fp.fileno(), 0, access=mmap.ACCESS_READ )
+        except ValueError:
+            # empty file
+            pass
+
+        self._parse_header()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, exc_traceback ):
+        self.close()
+
+    def __len__( self ):
+        return len(self.records)
+
+    def __getitem__( self, idx ):
+        return self.records[idx]
+
+    def _parse_header( self ):
+        if( self.mm is None or len(self.mm) < PPG_HEADER.size ):
+            raise EOFError( 'Failed to read PPG file header' )
+
+        (magic, version, self.sample_rate, self.ppg_len, self.record_size, self.start_ns, self.start_mono_ns, name) = PPG_HEADER.unpack_from( self.mm )
+
+        if( magic != PPG_MAGIC ):
+            raise ImportError( 'Not a PPG capture file' )
+
+        if( version != PPG_VERSION ):
+            raise ImportError( 'Only version %d PPG files supported (file claims to be v%d)' % (PPG_VERSION, version) )
+
+        self.name = name.rstrip( b'\0' ).decode( 'utf-8', 'replace' )
+
+        self.dtype = np.dtype( [ ('time', '<i8'), ('spo2', 'u1'), ('hr', 'u1'), ('battery', 'u1'), ('motion', 'u1'),
+            ('count', '<u2'), ('ppg', 'u1', (self.ppg_len,)) ] )
+
+        if( self.dtype.itemsize != self.record_size ):
+            raise ImportError( 'PPG record size mismatch, file probably corrupt' )
+
+        # a partly written last record is ignored
+        n = (len(self.mm) - PPG_HEADER.size) // self.record_size
+        self.records = np.frombuffer( self.mm, self.dtype, count=n, offset=PPG_HEADER.size )
+
+    def samples( self ):
+        """ (records, ppg_len) view of the raw samples, padding included """
+        return self.records['ppg']
+
+    def waveform( self ):
+        """ All valid samples as one flat array (a copy) """
+        ppg = self.records['ppg']
+        count = self.records['count']
+        if( len(count) and (count == self.ppg_len).all() ):
+            return ppg.reshape( -1 )
+        return ppg[ np.arange( self.ppg_len ) < count[:, None] ]
+
+    def timeline( self, max_lag=0.5 ):
+        """
+        Index of each record's first sample on the stitched timeline, and
+        the o2ppgstream used, whose dropped/gaps count the lost samples
+        """
+        stream = o2ppgstream( self.sample_rate, max_lag )
+        first = np.array( [ stream.add( t, c )[0] for t, c in zip( self.records['time'].tolist(), self.records['count'].tolist() ) ], dtype='<i8' )
+        return (first, stream)
+
+    def wall_time( self, mono_ns ):
+        """ Convert monotonic ns from this file to ns since the epoch """
+        return mono_ns - self.start_mono_ns + self.start_ns
+
+    def close( self ):
+        self.records = None
+        if( self.mm ):
+            try:
+                self.mm.close()
+            except BufferError:
+                # arrays taken from records still point into the map, let them keep it
+                pass
+            self.mm = None
+        if( self.fp ):
+            self.fp.close()
+            self.fp = None
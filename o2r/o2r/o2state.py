@@ -374,6 +374,7 @@ import time
 import json
 import pprint
 import struct
+import asyncio
 import os.path
 import datetime
 
@@ -381,6 +382,14 @@ from .defines import *
 from .o2pkt import o2pkt
 from .o2cmd import o2cmd
 from .o2file import *
+from .o2ppg import o2ppgstream, RT_SPO2, RT_HR, RT_BATTERY, RT_MOTION, RT_PPG
+from .o2clock import o2clock
+
+# seconds between sensor reads
+READ_INTERVAL = 1.0
+
+# bytes of a download between .part checkpoints, a crash loses at most this much
+CHECKPOINT_BYTES = 64 * 1024
 
 class o2state:
     def __init__(self, name, data, args):
@@ -389,11 +398,14 @@ class o2state:
         self.send_func = data['send']
         self.busy_func = data['busy']
         self.disconnect_func = data['disconnect']
+        self.cancel_func = data['cancel']
         self.realtime = args.realtime
+        self.stream = getattr(args, 'stream', False)
         self.args = args
 
         # internal state
-        self.next_read = 0
+        self.next_read = 0      # loop.time() the next sensor/config read is due, 0 for none
+        self.wake = None        # loop.call_at() handle for next_read
         self.need_cfg = False
         self.sent_cfg = False
         self.quiet_cfg = False
@@ -404,7 +416,18 @@ class o2state:
         self.read_fp = None
         self.read_size = 0
         self.read_want = 0
+        self.read_window = data.get('window', 1)
+        self.read_next = 0
+        self.read_blocks = None
+        self.read_pending = {}
+        self.read_started = 0
+        self.read_resumed = 0
+        self.read_saved = 0     # .part offset at the last checkpoint
+        self.read_rate = 0
         self.no_finger_count = 0
+        self.suspended = False
+        self.ppg_stream = o2ppgstream()
+        self.clock = o2clock()
         self.disconnect_at = 1
 
         print('Starting up for', self.name)
@@ -420,8 +443,14 @@ class o2state:
                 'motion','hr_strength','finger_present'
             }
           - CMD_RT_DATA: returns {
-                'timestamp','ppg_bytes'
+                'monotonic','time_ns','ppg_bytes',
+                'sample','dropped',
+                'spo2','hr','battery','motion'
             }
+            monotonic is the arrival time (time.monotonic_ns()), time_ns
+            the fitted time of the first PPG sample (ns since the epoch, see
+            o2clock), sample its index on the stitched timeline and dropped
+            the samples lost just before it
         Returns None for all other commands.
         """
         # debug‐print raw if verbose
@@ -434,8 +463,9 @@ class o2state:
 
         # 1) one‐shot sensor read
         if pkt.cmd == CMD_READ_SENSORS:
-            # schedule next reading in 1s
-            self.next_read = time.time() + 1.0
+            # keep reading, check() already set the next one if it sent this
+            if not self.next_read:
+                self.read_after(READ_INTERVAL)
 
             buf = pkt.recv_data
             o2 = buf[0]
@@ -458,16 +488,32 @@ class o2state:
 
         # 2) realtime PPG waveform
         elif pkt.cmd == CMD_RT_DATA:
-            ts = datetime.datetime.utcnow().isoformat()
+            mono = time.monotonic_ns()
             ppg = pkt.recv_data  # raw bytes of waveform
-            return {
-                'timestamp': ts,
-                'ppg_bytes': ppg
+            count = max(0, len(ppg) - RT_PPG)
+            (sample, dropped) = self.ppg_stream.add(mono, count)
+            self.clock.add(sample + count, mono)
+            if dropped and self.verbose > 0:
+                print(f"[{self.name}] Lost {dropped} PPG samples before sample {sample}")
+
+            # streaming, ask for the next one straight away
+            if self.stream:
+                self.read_after(0)
+
+            result = {
+                'monotonic': mono,
+                'time_ns':   self.clock.wall_ns(sample),
+                'ppg_bytes': ppg,
+                'sample':    sample,
+                'dropped':   dropped
             }
+            if len(ppg) > RT_PPG:
+                result.update(spo2=ppg[RT_SPO2], hr=ppg[RT_HR], battery=ppg[RT_BATTERY], motion=ppg[RT_MOTION])
+            return result
 
         # 3) info/config reply
         elif pkt.cmd == CMD_INFO:
-            self.current_cfg = json.loads(pkt.recv_data.decode('ascii').rstrip('\0\r\n\t '))
+            self.current_cfg = json.loads(str(pkt.recv_data, 'ascii').rstrip('\0\r\n\t '))
             if not self.quiet_cfg:
                 print(f"[{self.name}] Config:")
                 pprint.PrettyPrinter(indent=4).pprint(self.current_cfg)
@@ -482,11 +528,12 @@ class o2state:
             self.need_cfg = False
             self.check_settings()
             self.add_files(self.current_cfg['FileList'])
-            # self.get_file()
+            if self.args.download:
+                self.get_file()
 
-            # trigger first sensor if idle
-            if self.next_read < 1 and self.read_file_in is None:
-                self.next_read = time.time() + 1.0
+            # start the sensor reads, they carry on alongside any download
+            if not self.next_read:
+                self.read_after(0)
 
             return None
 
@@ -495,51 +542,61 @@ class o2state:
             if pkt.recv_cmd != 0:
                 print(f"[{self.name}] File open failed: {self.read_file_in}")
                 self.send_func(o2pkt(CMD_FILE_CLOSE))
-                self.next_read = time.time() + 1.0
                 return None
 
             # initialize file read
             self.read_block = 0
-            self.next_read = 0
+            self.read_next = 1
+            self.read_blocks = None
+            self.read_pending = {}
+            self.read_started = time.time()
             self.read_want = self.read_size = struct.unpack('<I', pkt.recv_data)[0]
             if self.verbose > 0:
                 print(f"[{self.name}] Opened {self.read_file_in}, size={self.read_size}")
+
+            self.open_part()
+
+            if self.verbose > 0:
                 print('|', end='', flush=True)
                 self.read_percent = 1
 
-            self.send_func(o2pkt(CMD_FILE_READ, block=self.read_block))
-            self.read_fp = open(self.read_file_out, 'wb')
+            if self.read_want > 0:
+                # the first block goes alone, its size tells us how many blocks to pipeline
+                self.read_next = self.read_block + 1
+                self.send_func(o2pkt(CMD_FILE_READ, block=self.read_block))
+            else:
+                self.finish_file()
             return None
 
         elif pkt.cmd == CMD_FILE_READ:
-            # write chunk, progress bar update
-            self.read_want -= len(pkt.recv_data)
-            self.read_block += 1
-            if self.read_fp:
-                self.read_fp.write(pkt.recv_data)
+            if self.read_file_in is None:
+                # a pipelined read still in flight when the file was abandoned
+                return None
+
+            if self.read_blocks is None:
+                size = len(pkt.recv_data)
+                self.read_blocks = self.read_block + (-(-self.read_want // size) if size else 1)
+
+            # replies can arrive out of order, write them out in block order
+            self.read_pending[pkt.block] = pkt.recv_data
+            if not self.write_blocks():
+                # the ring ran out before the size it gave us, don't pass
+                #  off what we have as the whole file
+                self.abandon_file(f"empty reply to block {self.read_block} with {self.read_want} bytes still to come")
+                return None
 
             if self.read_want > 0:
                 # still more
-                self.send_func(o2pkt(CMD_FILE_READ, block=self.read_block))
+                self.request_blocks()
             else:
-                # done reading
-                self.send_func(o2pkt(CMD_FILE_CLOSE))
-                if self.read_fp:
-                    self.read_fp.close()
-                # optionally convert to CSV
-                # if self.args.csv:
-                #     self._convert_vld_to_csv()
-                # reset and grab next
-                self.read_fp = None
-                self.read_file_in = None
-                self.read_file_out = None
-                # self.get_file()
+                # all in, any blocks pending or in flight are past the end
+                self.read_pending = {}
+                self.cancel_func(CMD_FILE_READ)
+                self.finish_file()
             return None
 
         elif pkt.cmd == CMD_FILE_CLOSE:
-            # once files done, resume sensors
-            if self.read_file_in is None:
-                self.send_func(o2pkt(CMD_READ_SENSORS))
+            self.file_closed()
             return None
 
         elif pkt.cmd == CMD_CONFIG:
@@ -550,24 +607,256 @@ class o2state:
         # everything else
         return None
 
+    def suspend(self):
+        """
+        The link dropped.  Stop reading and put any download back at the
+        head of the file list, everything else is kept for resume().
+        """
+        self.suspended = True
+        self.read_after(None)
+
+        if self.read_file_in is not None:
+            # the .part and its checkpoint let it pick up where it stopped
+            self.checkpoint()
+            if self.read_fp:
+                self.read_fp.close()
+                self.read_fp = None
+            self.want_files.insert(0, self.read_file_in)
+            self.read_pending = {}
+            self.read_file_in = None
+            self.read_file_out = None
+
+    def resume(self, data):
+        """ Carry on over a new link without going through CMD_INFO again """
+        self.send_func = data['send']
+        self.busy_func = data['busy']
+        self.disconnect_func = data['disconnect']
+        self.cancel_func = data['cancel']
+        self.read_window = data.get('window', 1)
+        self.suspended = False
+
+        print(f"[{self.name}] Resuming")
+        if self.sent_cfg:
+            # the config write may have been lost with the link, read the
+            #  config again so check_settings() can tell
+            self.sent_cfg = False
+            self.need_cfg = True
+
+        if not hasattr(self, 'current_cfg'):
+            # dropped before the config came in, start over
+            self.send_func(o2pkt(CMD_INFO))
+            self.req_time_str = time.strftime(TIME_FORMAT)
+            return
+
+        if self.args.download:
+            self.get_file()
+        self.read_after(0)
+
+    def failed(self, pkt):
+        """ O2BTDevice gave up on pkt after retrying it """
+        if pkt.cmd in (CMD_FILE_OPEN, CMD_FILE_READ) and self.read_file_in is not None:
+            self.abandon_file(f"command {pkt.cmd} failed")
+        elif pkt.cmd == CMD_FILE_CLOSE:
+            # the ring may still have the file open, if so the next open
+            #  fails and is abandoned in turn, but the downloads carry on
+            print(f"[{self.name}] File close failed, carrying on")
+            if self.read_file_in is None:
+                self.file_closed()
+        elif pkt.cmd == CMD_INFO:
+            # never got the config, ask again at the next read
+            self.need_cfg = True
+            if not self.next_read:
+                self.read_after(READ_INTERVAL)
+
+    def file_closed(self):
+        """ The last file is closed (or given up on), on to the next one """
+        if self.read_fp:
+            self.read_fp.close()
+            self.read_fp = None
+        self.read_pending = {}
+        self.read_file_in = None
+        self.read_file_out = None
+
+        if self.args.download:
+            self.get_file()
+
+        # once files done, make sure the sensor reads are going
+        if self.read_file_in is None and not self.next_read:
+            self.read_after(0)
+
+    def abandon_file(self, why):
+        """ Give up on the current download, keeping the .part and its checkpoint to resume next time """
+        print(f"[{self.name}] Abandoning {self.read_file_in} ({why}), it will resume next time")
+        self.cancel_func(CMD_FILE_READ)
+        self.checkpoint()
+        if self.read_fp:
+            self.read_fp.close()
+            self.read_fp = None
+        self.read_pending = {}
+        self.read_file_in = None
+        self.read_file_out = None
+        # move on to the next file once closed
+        self.send_func(o2pkt(CMD_FILE_CLOSE))
+
+    def read_after(self, delay):
+        """
+        Schedule the next sensor/config read delay seconds from now, or
+        cancel it with None.  check() is called right at the deadline, and
+        again by the main loop each time a reply comes in, so a read held up
+        behind an earlier one goes out as soon as that is answered.
+        """
+        if self.wake is not None:
+            self.wake.cancel()
+            self.wake = None
+
+        if delay is None:
+            self.next_read = 0
+            return
+
+        loop = asyncio.get_event_loop()
+        self.next_read = loop.time() + delay
+        self.wake = loop.call_at(self.next_read, self._wake)
+
     def check(self):
-        if self.busy_func():
+        # file transfers have their own queue in O2BTDevice, only wait for
+        #  our own realtime and config commands
+        if self.busy_func(PRIO_REALTIME) or self.busy_func(PRIO_CONFIG):
+            return
+
+        if not self.next_read:
             return
 
         # time for next read?
-        if self.next_read > 0 and time.time() >= self.next_read:
-            self.next_read = 0
-            if self.need_cfg:
-                self.send_func(o2pkt(CMD_INFO))
-                self.req_time_str = time.strftime(TIME_FORMAT)
-            else:
-                self.next_read = time.time() + 1.0
-                self.send_func(o2pkt(CMD_READ_SENSORS))
-                if self.realtime:
-                    self.send_func(o2pkt(CMD_RT_DATA, long=True))
+        if asyncio.get_event_loop().time() < self.next_read:
+            # woken early (timer resolution), make sure we are woken again
+            if self.wake is None:
+                self.wake = asyncio.get_event_loop().call_at(self.next_read, self._wake)
+            return
+
+        self.read_after(None)
+        if self.need_cfg:
+            self.send_func(o2pkt(CMD_INFO))
+            self.req_time_str = time.strftime(TIME_FORMAT)
+        else:
+            # the interval runs from the request, not the reply
+            self.read_after(READ_INTERVAL)
+            if self.stream:
+                # RT_DATA carries spo2/hr too, and each reply asks for the next
+                self.send_func(o2pkt(CMD_RT_DATA, long=True))
+                return
+            self.send_func(o2pkt(CMD_READ_SENSORS))
+            if self.realtime:
+                self.send_func(o2pkt(CMD_RT_DATA, long=True))
+
+    def _wake(self):
+        self.wake = None
+        self.check()
+
+    def open_part( self ):
+        """
+        Open "<read_file_out>.part" for writing.  If its ".json" sidecar says
+        it holds the start of this same file, pick up from the last
+        checkpointed block instead of block 0.
+        """
+        part = self.read_file_out + '.part'
+
+        try:
+            with open( part + '.json' ) as f:
+                saved = json.load( f )
+
+            if( saved['file'] == self.read_file_in and saved['size'] == self.read_size and os.path.getsize( part ) >= saved['offset'] ):
+                self.read_fp = open( part, 'r+b' )
+                self.read_fp.truncate( saved['offset'] )
+                self.read_fp.seek( saved['offset'] )
+                self.read_block = saved['block']
+                self.read_want = self.read_size - saved['offset']
+                self.read_resumed = self.read_saved = saved['offset']
+                if( self.verbose > 0 ):
+                    print( '[%s] Resuming at block %d, %d bytes already saved' % (self.name, self.read_block, saved['offset']) )
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self.read_fp = open( part, 'wb' )
+        self.read_resumed = self.read_saved = 0
+
+    def checkpoint( self ):
+        """
+        Record how much of the .part file is good so a later session can
+        resume it.  Done every CHECKPOINT_BYTES while reading, and always on
+        suspend, abandon and close.
+        """
+        if( not self.read_fp ):
+            return
+
+        # the data has to be on disk before the sidecar says it is
+        self.read_fp.flush()
+        os.fsync( self.read_fp.fileno() )
+
+        offset = self.read_size - self.read_want
+        side = self.read_file_out + '.part.json'
+        with open( side + '.tmp', 'w' ) as f:
+            json.dump( {'file': self.read_file_in, 'size': self.read_size, 'block': self.read_block, 'offset': offset}, f )
+        os.replace( side + '.tmp', side )
+        self.read_saved = offset
+
+    def finish_file( self ):
+        self.send_func( o2pkt(CMD_FILE_CLOSE) )
+        if( self.read_fp ):
+            self.read_fp.close()
+            # only a complete file gets its real name
+            os.replace( self.read_file_out + '.part', self.read_file_out )
+            try:
+                os.remove( self.read_file_out + '.part.json' )
+            except FileNotFoundError:
+                pass
+
+        secs = time.time() - self.read_started
+        self.read_rate = (self.read_size - self.read_resumed) / secs if secs > 0 else 0
+        if( self.verbose > 0 ):
+            print( '[%s] Read %s: %d bytes in %.1fs (%.0f B/s)' % (self.name, self.read_file_in, self.read_size, secs, self.read_rate) )
+
+        # optionally convert to CSV
+        # if self.args.csv:
+        #     self._convert_vld_to_csv()
+        # reset, the next file is requested once the close is acknowledged
+        self.read_fp = None
+        self.read_file_in = None
+        self.read_file_out = None
+
+    def write_blocks( self ):
+        """ Write out the pending blocks that are next in line, False if one of them came back empty too soon """
+        wrote = False
+        while( self.read_block in self.read_pending ):
+            data = self.read_pending.pop( self.read_block )
+            if( not data and self.read_want > 0 ):
+                return False
+
+            self.read_want -= len(data)
+            self.read_block += 1
+            if( self.read_fp ):
+                self.read_fp.write( data )
+                wrote = True
+
+        if( wrote and self.read_want > 0 and self.read_size - self.read_want - self.read_saved >= CHECKPOINT_BYTES ):
+            self.checkpoint()
+
+        return True
+
+    def request_blocks( self ):
+        # keep up to read_window block reads in flight
+        if( self.read_next <= self.read_block ):
+            # blocks came back shorter than the first one, keep going one at a time
+            self.read_blocks = max( self.read_blocks, self.read_block + 1 )
+
+        last = min( self.read_blocks, self.read_block + self.read_window )
+        while( self.read_next < last ):
+            self.send_func( o2pkt(CMD_FILE_READ, block=self.read_next) )
+            self.read_next += 1
 
     def add_files( self, flist ):
-        self.want_files.extend( [i for i in flist.split(',') if i] )
+        # the list comes again with every config read
+        self.want_files.extend( [i for i in flist.split(',') if i and i not in self.want_files] )
         if( (self.verbose > 0) and (not self.quiet_cfg) ):
             print( '[%s] File List is now' % self.name, self.want_files )
 
@@ -609,7 +898,16 @@ class o2state:
         #    self.send_func( o2pkt(CMD_READ_SENSORS) )
 
     def close( self ):
-        self.next_read = 0
+        # leave a partly downloaded file ready to resume
+        self.checkpoint()
+        if( self.read_fp ):
+            self.read_fp.close()
+            self.read_fp = None
+
+        self.read_after(None)
+        if self.ppg_stream.samples and self.verbose > 0:
+            s = self.ppg_stream
+            print(f"[{self.name}] PPG: {s.samples} samples, {s.dropped} dropped in {s.gaps} gaps")
         self.want_files = [ ]
         self.read_want = 0
         #self.dev.disconnect()
@@ -175,6 +175,7 @@ import o2r
 import threading, time, queue, traceback
 import argparse
 import json
+import datetime
 
 
 import asyncio
@@ -210,6 +211,20 @@ async def main():
     arg_parser.add_argument( '-e', '--ext', default='vld', metavar='EXT' )
     arg_parser.add_argument( '--csv', action="store_true", default=False)
     arg_parser.add_argument( '--realtime', action="store_true", default=True)
+    arg_parser.add_argument( '--stream', action="store_true", help='Request realtime data back to back for a gapless 125Hz PPG waveform, instead of sensor reads once a second' )
+    arg_parser.add_argument( '--download', action="store_true", help='Download files from the ring' )
+    arg_parser.add_argument( '--window', type=int, default=1, help='File blocks to keep requested at once (default: 1)' )
+    arg_parser.add_argument( '--timeout', type=float, default=3.0, help='Seconds to wait for a reply before resending a command (default: 3)' )
+    arg_parser.add_argument( '--retries', type=int, default=3, help='Times to resend a command before giving up on it (default: 3)' )
+    arg_parser.add_argument( '--no-reconnect', action="store_true", help="Don't reconnect rings that drop out" )
+    arg_parser.add_argument( '--reconnect-max', type=float, default=60.0, help='Longest wait between reconnect attempts in seconds (default: 60)' )
+    arg_parser.add_argument( '--gatt-cache', metavar='FILE', default=o2r.GATT_CACHE_FILE, help='Where to cache ring GATT handles for faster connects (default: %(default)s)' )
+    arg_parser.add_argument( '--no-gatt-cache', action="store_true", help="Always do full service discovery, don't use or update the GATT cache" )
+    arg_parser.add_argument( '--write-size', type=int, default=0, help='Bytes per BLE write (default: 0, sized from the negotiated MTU; 20 for the old behaviour)' )
+    arg_parser.add_argument( '--write-response', action="store_true", help='Always wait for each BLE write to be acknowledged' )
+    arg_parser.add_argument( '--flush-interval', type=float, default=1.0, help='Seconds between realtime log writes (default: 1)' )
+    arg_parser.add_argument( '--flush-bytes', type=int, default=65536, help='Write the realtime log early once this much is buffered' )
+    arg_parser.add_argument( '--rt-format', choices=('hex', 'bin'), default='hex', help='Realtime log format, hex text (.rt) or binary records (.rtb)' )
     arg_parser.add_argument( '--o2-alert', type=int, choices=range(0,101) )
     arg_parser.add_argument( '--hr-alert-high', type=int, choices=range(0,201) )
     arg_parser.add_argument( '--hr-alert-low',  type=int, choices=range(0,201) )
@@ -228,6 +243,15 @@ async def main():
     manager = o2r.O2DeviceManager()
     manager.verbose = args.verbose + 1
     manager.queue = asyncio.Queue()
+    manager.window = args.window
+    manager.timeout = args.timeout
+    manager.retries = args.retries
+    manager.reconnect = not args.no_reconnect
+    manager.backoff_max = args.reconnect_max
+    manager.write_size = args.write_size
+    manager.write_response = args.write_response
+    if not args.no_gatt_cache:
+        manager.gatt_cache = o2r.o2gattcache( args.gatt_cache )
 
     await manager.start_discovery()
     scanning = True
@@ -238,11 +262,19 @@ async def main():
     # Sensors Variable
     sensor = None
     ppg_file = None
+    rt_log = o2r.o2logwriter(args.flush_interval, args.flush_bytes)
+    rt_log.start()
+    ppg_writers = {}
 
     try:
         while run:
+            # nothing to poll for, the rings schedule their own reads, so only
+            #  wake for the next event or the next deadline
+            deadlines = [t for t in (stop_reading_at, stop_scanning_at if not rings else 0) if t]
+            timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+
             try:
-                cmd = await asyncio.wait_for(manager.queue.get(), 1.0)
+                cmd = await asyncio.wait_for(manager.queue.get(), timeout)
             except asyncio.TimeoutError:
                 cmd = None
             except asyncio.CancelledError:
@@ -258,9 +290,13 @@ async def main():
 
                 if command == 'READY':
                     data.setdefault('verbose', args.verbose+1)
-                    if ident in rings:
-                        rings[ident].close()
-                    rings[ident] = o2r.o2state(data['name'], data, args)
+                    if ident in rings and rings[ident].suspended:
+                        # back after a drop, carry on where it left off
+                        rings[ident].resume(data)
+                    else:
+                        if ident in rings:
+                            rings[ident].close()
+                        rings[ident] = o2r.o2state(data['name'], data, args)
                     if not args.multi and scanning:
                         await manager.stop_discovery()
                         scanning = False
@@ -271,6 +307,14 @@ async def main():
                     if not scanning and not rings:
                         want_exit = True
 
+                elif command == 'LOST':
+                    if ident in rings:
+                        rings[ident].suspend()
+
+                elif command == 'FAILED':
+                    if ident in rings:
+                        rings[ident].failed(data)
+
                 elif command == 'BTDATA':
                     # **HERE** we capture and print returned dict
                     result = rings[ident].recv(data)
@@ -283,31 +327,32 @@ async def main():
                                     'hr'            : result['hr'],
                                     'battery'       : result['battery'],
                                     'motion'        : result['motion'],
-                                    'finger_present': 'Yes' if result['finger_present'] else 'No'
+                                    'finger_present': ('Yes' if result['finger_present'] else 'No') if 'finger_present' in result else 'Unknown'
                                 }
                             # print(f"[{rings[ident].name}] Sensor → SpO2={result['spo2']}%, "
                             #       f"HR={result['hr']} bpm, Batt={result['battery']}%, "
                             #       f"Motion={result['motion']}, Finger={'Yes' if result['finger_present'] else 'No'}")
                         # realtime PPG
-                        if 'ppg_bytes' in result:
-                            ts = result['timestamp']
+                        if 'ppg_bytes' in result and args.rt_format == 'bin':
+                            if ident not in ppg_writers:
+                                ppg_file = f"{rings[ident].name} - {time.strftime('%Y%m%d-%H%M%S')}.rtb"
+                                ppg_writers[ident] = o2r.o2ppgwriter(ppg_file, rings[ident].name, log=rt_log)
+                            ppg_writers[ident].add(result['monotonic'], result['ppg_bytes'])
+                        elif 'ppg_bytes' in result:
+                            ts = datetime.datetime.fromtimestamp(result['time_ns'] / 1e9, datetime.timezone.utc).replace(tzinfo=None).isoformat(timespec='microseconds')
                             ppg = result['ppg_bytes'].hex()
 
                             ppg_file = f"ppg_data.rt"
                             # print(f"Before putting the file: {pkt.recv_data}")
-                            with open(ppg_file, "a") as f:
-                                f.write(ts)
-                                f.write("|")
-                                f.write(ppg)
-                                f.write("\n")
+                            rt_log.write(ppg_file, f"{ts}|{ppg}\n")
                             # print(f"[{rings[ident].name}] PPG @ {ts}: {ppg}")
 
                 else:
                     print('unhandled command:', cmd)
 
-            # run each state machine’s periodic check
-            for st in rings.values():
-                st.check()
+            # a reply in means the ring may be free for whatever is due next
+            if cmd and ident in rings:
+                rings[ident].check()
 
             if want_exit or time.time()>=stop_reading_at or (stop_scanning_at and time.time()>=stop_scanning_at and not rings):
                 run = False
@@ -322,6 +367,10 @@ async def main():
                  for dev in manager.devices.values()
                  if dev.is_connected]
         await asyncio.gather(*tasks, return_exceptions=True)
+        for w in ppg_writers.values():
+            if w.split:
+                print(f"[{w.name}] {w.split} realtime packets were longer than {w.ppg_len} samples and split over several records")
+        await rt_log.close()
         # asyncio.gather(*tasks)
         # await asyncio.sleep(0.5)
     return sensor, ppg_file